@@ -1,25 +1,39 @@
 import random
-from collections import defaultdict, deque
+from collections import deque
 from abc import ABC, abstractmethod
-import pickle
+
+import numpy as np
+
+import instrumentation
+from environments import FEATURE_SIZE
+from game import SnakeGame
+from model_format import (MODEL_EXTENSION, POLICY_MAGIC, is_model_file, is_symmetric, load_pickle,
+                          load_policy, load_q_table, save_pickle, save_policy, save_q_table)
+from q_networks import QNetwork
+from q_tables import ACTION_INDEX, ACTIONS, VOCABULARIES, DictQTable, DenseQTable, greedy_policy, infer_vocabulary
+from replay_buffers import FeatureReplayBuffer, ReplayBatch, ReplayBuffer
+from returns import lambda_returns, n_step_returns
 
 
 class Agent(ABC):
+    """
+    Every agent acts. Learning agents override `update` and `train`;
+    frozen and planning agents keep these no-ops.
+    """
     @abstractmethod
     def act(self, state, actions):
         pass
 
-    @abstractmethod
     def update(self, state, action, reward, next_state, next_actions):
         pass
 
-    @abstractmethod
-    def train(self, env, episodes):
+    def train(self):
         pass
 
 
 class QLearningAgent(Agent):
-    def __init__(self, alpha=0.1, gamma=0.99, epsilon=0.5, epsilon_decay=0.995, minimum_epsilon=0.01, buffer_size=1000, batch_size=32):
+    def __init__(self, alpha=0.1, gamma=0.99, epsilon=0.5, epsilon_decay=0.995, minimum_epsilon=0.01, buffer_size=1000, batch_size=32,
+                 q_table=None, buffer=None, encoder=None, n_step=None, trace_lambda=None, symmetric=None):
         """
         Initialize the Q-learning agent using defaultdict.
         Args:
@@ -28,17 +42,38 @@ class QLearningAgent(Agent):
             epsilon (float): Exploration rate.
             buffer_size (int): Maximum size of the replay buffer.
             batch_size (int): Number of experiences to sample for training.
+            q_table: Q-table backend from q_tables, a DictQTable by default.
+            buffer: Replay buffer from replay_buffers, a deque of
+                `buffer_size` experiences by default.
+            encoder (str): Name of the observation encoder of its states,
+                recorded in saved models. Taken from the Q-table when None,
+                and set by `load`.
+            n_step (int): Also update every state of a finished episode
+                towards its n-step return, in one backward pass.
+            trace_lambda (float): Same with λ-returns instead, as in
+                Peng's Q(λ). At most one of n_step and trace_lambda.
+            symmetric (bool): Whether its states are canonical under the
+                board symmetries, recorded in saved models. Unknown if None
+                until set by training or `load`.
         """
+        if n_step is not None and trace_lambda is not None:
+            raise ValueError("Choose either n_step or trace_lambda returns")
         self.alpha = alpha
         self.gamma = gamma
         self.epsilon = epsilon
         self.epsilon_decay = epsilon_decay
         self.minimum_epsilon = minimum_epsilon
-        self.q_table = defaultdict(lambda: defaultdict(float))  # Default Q-values to 0.0
+        self.q_table = q_table if q_table is not None else DictQTable()  # Default Q-values to 0.0
 
         # Replay buffer
-        self.buffer = deque(maxlen=buffer_size)
+        self.buffer = buffer if buffer is not None else deque(maxlen=buffer_size)
         self.batch_size = batch_size
+        self.encoder = encoder
+        self.symmetric = symmetric
+        self.n_step = n_step
+        self.trace_lambda = trace_lambda
+        # transitions of the current episode, for the multi-step returns
+        self.episode = []
 
     def act(self, state, actions, ignore_exploration=False):
         """
@@ -55,9 +90,9 @@ class QLearningAgent(Agent):
         # print("agent is exploiting")
         # print("Current state:", state)
         # print("Q-values for current state:", self.q_table[state])
-        return max(actions, key=lambda action: self.q_table[state][action])  # Exploit
+        return self.q_table.best_action(state, actions)  # Exploit
 
-    def update(self, state, action, reward, next_state, next_actions):
+    def update(self, state, action, reward, next_state, next_actions, weight=1.0):
         """
         Update the Q-table using the Bellman equation.
         Args:
@@ -66,11 +101,90 @@ class QLearningAgent(Agent):
             reward (float): Reward received.
             next_state: Next state (hashable).
             next_actions (list): List of possible actions in the next state.
+            weight (float): Importance-sampling weight scaling the step.
+        Returns:
+            float: The TD error before the update.
         """
-        max_next_q_value = max([self.q_table[next_state][a] for a in next_actions], default=0)
+        max_next_q_value = self.q_table.max_q_value(next_state, next_actions)
         td_target = reward + self.gamma * max_next_q_value
-        td_delta = td_target - self.q_table[state][action]
-        self.q_table[state][action] += self.alpha * td_delta
+        td_delta = td_target - self.q_table.q_value(state, action)
+        self.q_table.add(state, action, self.alpha * weight * td_delta)
+        return td_delta
+
+    def update_batch(self, batch):
+        """
+        Apply the Bellman update to a whole ReplayBatch at once, computing
+        every TD target from the Q-values before the update. Needs a
+        DenseQTable and a buffer that share its vocabulary.
+
+        Experiences hitting the same state-action pair are merged instead
+        of summed: k updates with mean TD error d move the value by
+        (1 - (1 - alpha) ** k) * d, as k sequential updates towards the
+        same target would. Large batches with many duplicates stay stable.
+        Args:
+            batch (ReplayBatch): Sampled experiences.
+        Returns:
+            np.ndarray: The TD error of every experience before the update.
+        """
+        values = self.q_table.values
+        max_next_q_values = np.where(batch.dones, 0,
+                                     values[batch.next_states].max(axis=1))
+        td_targets = batch.rewards + self.gamma * max_next_q_values
+        td_deltas = td_targets - values[batch.states, batch.actions]
+        self._add_merged(batch.states, batch.actions, batch.weights * td_deltas)
+        return td_deltas
+
+    def _add_merged(self, state_ids, action_ids, td_deltas):
+        # one step per distinct state-action pair of a DenseQTable, see update_batch
+        values = self.q_table.values
+        pairs = state_ids * values.shape[1] + action_ids
+        unique_pairs, inverse, counts = np.unique(pairs, return_inverse=True,
+                                                  return_counts=True)
+        delta_sums = np.bincount(inverse, weights=td_deltas,
+                                 minlength=len(unique_pairs))
+        steps = (1 - (1 - self.alpha) ** counts) * delta_sums / counts
+        values.reshape(-1)[unique_pairs] += steps.astype(values.dtype)
+        self.q_table.visited[state_ids] = True
+
+    def update_episode(self, transitions, done=True):
+        """
+        Move the Q-value of every step of an episode towards its n-step or
+        λ-return, all computed from the Q-values before the update.
+        Args:
+            transitions (list): (state, action, reward, next_state, done)
+                experiences of the episode, in order.
+            done (bool): Whether the episode ended in a terminal state,
+                rather than being cut short.
+        Returns:
+            np.ndarray: The error of every step's return before the update.
+        """
+        states, actions, rewards, next_states, dones = zip(*transitions)
+        if isinstance(self.q_table, DenseQTable):
+            ids = self.q_table.vocabulary.ids
+            values = self.q_table.values
+            state_ids = np.array([ids[state] for state in states])
+            action_ids = np.array([ACTION_INDEX[action] for action in actions])
+            next_values = np.where(dones, 0, values[[ids[state] for state in next_states]].max(axis=1))
+            q_values = values[state_ids, action_ids]
+        else:
+            next_values = [0.0 if next_done else
+                           self.q_table.max_q_value(next_state, self.q_table.known_actions(next_state))
+                           for next_state, next_done in zip(next_states, dones)]
+            q_values = np.array([self.q_table.q_value(state, action)
+                                 for state, action in zip(states, actions)])
+
+        if self.n_step is not None:
+            targets = n_step_returns(rewards, next_values, self.gamma, self.n_step, done)
+        else:
+            targets = lambda_returns(rewards, next_values, self.gamma, self.trace_lambda, done)
+        td_deltas = targets - q_values
+
+        if isinstance(self.q_table, DenseQTable):
+            self._add_merged(state_ids, action_ids, td_deltas)
+        else:
+            for state, action, td_delta in zip(states, actions, td_deltas.tolist()):
+                self.q_table.add(state, action, self.alpha * td_delta)
+        return td_deltas
 
     def store_experience(self, state, action, reward, next_state, done):
         """
@@ -80,9 +194,17 @@ class QLearningAgent(Agent):
             action: Action taken.
             reward (float): Reward received.
             next_state: Next state (hashable).
-            done (bool): Whether the episode is finished.
+            done (bool): Whether the episode is finished. With n_step or
+                trace_lambda, the episode is learned from at once then;
+                experiences must come from one environment, in order.
         """
         self.buffer.append((state, action, reward, next_state, done))
+        if self.n_step is None and self.trace_lambda is None:
+            return
+        self.episode.append((state, action, reward, next_state, done))
+        if done:
+            self.update_episode(self.episode)
+            self.episode = []
 
     def train(self):
         """
@@ -91,15 +213,28 @@ class QLearningAgent(Agent):
         if len(self.buffer) < self.batch_size:
             return  # Not enough experiences to sample a full batch
 
-        batch = random.sample(self.buffer, self.batch_size)
+        if isinstance(self.buffer, deque):
+            batch = random.sample(self.buffer, self.batch_size)
 
-        for state, action, reward, next_state, done in batch:
-            # Determine the list of possible actions for the next_state
-            next_actions = list(self.q_table[next_state].keys()) if not done else []
-            self.update(state, action, reward, next_state, next_actions)
+            for state, action, reward, next_state, done in batch:
+                # Determine the list of possible actions for the next_state
+                next_actions = self.q_table.known_actions(next_state) if not done else []
+                self.update(state, action, reward, next_state, next_actions)
+        elif isinstance(self.q_table, DenseQTable) and isinstance(self.buffer, ReplayBuffer) \
+                and self.buffer.vocabulary is self.q_table.vocabulary:
+            # state IDs of the buffer index the table directly
+            batch = self.buffer.sample(self.batch_size)
+            self.buffer.update_priorities(batch.indices, self.update_batch(batch))
+        else:
+            batch = self.buffer.sample(self.batch_size)
+            td_deltas = []
+            for state, action, reward, next_state, done, weight in self.buffer.transitions(batch):
+                next_actions = self.q_table.known_actions(next_state) if not done else []
+                td_deltas.append(self.update(state, action, reward, next_state, next_actions, weight))
+            self.buffer.update_priorities(batch.indices, td_deltas)
         self.epsilon *= self.epsilon_decay
-        print("agent learned from a batch of experiences")
-        print("epsilon:", max(self.minimum_epsilon, self.epsilon))
+        instrumentation.trace("agent learned from a batch of experiences")
+        instrumentation.trace("epsilon:", max(self.minimum_epsilon, self.epsilon))
 
     def get_q_value(self, state, action):
         """
@@ -110,30 +245,335 @@ class QLearningAgent(Agent):
         Returns:
             float: Q-value.
         """
-        return self.q_table[state][action]
+        return self.q_table.q_value(state, action)
 
     def get_q_table(self):
         """
-        Get the Q-table as a dictionary.
+        Get the Q-table.
         Returns:
-            defaultdict: The nested Q-table.
+            The Q-table backend, a nested defaultdict for DictQTable.
         """
         return self.q_table
 
+    def get_encoder(self):
+        """
+        Name of the observation encoder of the Q-table's states: the agent's
+        own, else the one of its vocabulary or of the states it holds.
+        """
+        if self.encoder is not None:
+            return self.encoder
+        if isinstance(self.q_table, DenseQTable):
+            return self.q_table.vocabulary.name
+        return infer_vocabulary(self.q_table.to_dict()).name
+
     def save(self, filename):
         """
-        Save the Q-table to a file.
+        Save the Q-table to a file, recording its encoder and whether it is
+        symmetric. Filenames ending
+        in MODEL_EXTENSION get the binary model format of model_format,
+        others a pickle.
         Args:
             filename (str): The name of the file to save the Q-table.
         """
-        with open(filename, 'wb') as f:
-            pickle.dump(dict(self.q_table), f)
+        encoder = self.get_encoder()
+        if filename.endswith(MODEL_EXTENSION):
+            q_table = self.q_table
+            if not isinstance(q_table, DenseQTable):
+                q_table = DenseQTable.from_dict(q_table.to_dict(), VOCABULARIES[encoder])
+            save_q_table(q_table, filename, bool(self.symmetric))
+            return
+        save_pickle(self.q_table.to_dict(), encoder, filename, bool(self.symmetric))
 
     def load(self, filename):
         """
-        Load the Q-table from a file.
+        Load the Q-table from a file into the current backend, converting
+        it on the way if the backend is not a DictQTable.
+
+        Binary model files are memory-mapped copy-on-write: a DenseQTable
+        backend is replaced by a table viewing the mapped file, any other
+        backend loads a copy of its values.
         Args:
             filename (str): The name of the file to load the Q-table.
         """
-        with open(filename, 'rb') as f:
-            self.q_table = defaultdict(lambda: defaultdict(float), pickle.load(f))
+        if is_model_file(filename):
+            q_table = load_q_table(filename)
+            self.encoder = q_table.vocabulary.name
+            self.symmetric = is_symmetric(filename)
+            if isinstance(self.q_table, DenseQTable):
+                self.q_table = q_table
+            else:
+                self.q_table.load_dict(q_table.to_dict())
+            return
+        encoder, q_values, self.symmetric = load_pickle(filename)
+        if encoder is not None:
+            self.encoder = encoder
+            if isinstance(self.q_table, DenseQTable) and \
+                    self.q_table.vocabulary.name != encoder:
+                self.q_table = DenseQTable(VOCABULARIES[encoder])
+        self.q_table.load_dict(q_values)
+
+
+class PolicyAgent(Agent):
+    """
+    A trained agent frozen into its greedy policy: one uint8 action index per
+    state ID of a StateVocabulary. Acting is a single array lookup and never
+    explores; the policy cannot learn any more.
+    """
+    def __init__(self, vocabulary=None, policy=None, symmetric=False):
+        self.vocabulary = vocabulary
+        self.policy = policy
+        # whether the policy maps canonical states to canonical-frame actions
+        self.symmetric = symmetric
+
+    @property
+    def encoder(self):
+        # policies are saved with their vocabulary, named after its encoder
+        return self.vocabulary.name if self.vocabulary is not None else None
+
+    @classmethod
+    def from_q_table(cls, q_table):
+        """
+        Args:
+            q_table: A DenseQTable, DictQTable or nested {state: {action: value}} dict.
+        """
+        return cls(*greedy_policy(q_table))
+
+    def act(self, state, actions=None, ignore_exploration=True):
+        """
+        Return the greedy action of `state`. All actions are assumed possible.
+        """
+        return ACTIONS[self.policy[self.vocabulary.ids[state]]]
+
+    def act_batch(self, state_ids):
+        """
+        Return the greedy action index of every state ID in `state_ids`.
+        """
+        return self.policy[state_ids]
+
+    def save(self, filename):
+        """
+        Save the policy in the binary policy format of model_format.
+        """
+        save_policy(self.vocabulary, self.policy, filename, self.symmetric)
+
+    def load(self, filename):
+        """
+        Load a binary policy file, or compile the greedy policy of a Q-table
+        model file or pickle.
+        """
+        if is_model_file(filename, POLICY_MAGIC):
+            self.vocabulary, self.policy = load_policy(filename)
+            self.symmetric = is_symmetric(filename)
+            return
+        agent = QLearningAgent()
+        agent.load(filename)
+        self.symmetric = agent.symmetric
+        vocabulary = VOCABULARIES[agent.encoder] if agent.encoder is not None else None
+        self.vocabulary, self.policy = greedy_policy(agent.q_table, vocabulary)
+
+
+class SearchAgent(Agent):
+    """
+    Plans every move with Monte Carlo rollouts on a private copy of the
+    environment's game: each possible action is tried `rollouts` times,
+    followed by up to `depth - 1` moves of the rollout policy, and the
+    action with the best mean discounted return is played.
+
+    The copy is reset with SnakeGame.snapshot/restore before every rollout.
+    Apples eaten during a rollout respawn from the agent's own random
+    generator, so plans never peek at the real game's future apples.
+    """
+    def __init__(self, environment, rollouts=32, depth=8, gamma=0.9,
+                 prior=None, rollout_epsilon=0.1, seed=None):
+        """
+        Args:
+            environment: The SnakeEnvironment the agent plays in.
+            rollouts (int): Rollouts per possible action and move.
+            depth (int): Moves per rollout, the first one included.
+            gamma (float): Discount factor of the rollout returns.
+            prior: Optional agent with `act` and a `q_table`, such as a
+                trained QLearningAgent. Rollouts follow its greedy policy
+                and add its discounted max Q-value at the leaf; without one
+                they move at random.
+            rollout_epsilon (float): Chance of a random rollout move when
+                following the prior.
+            seed (int): Seed of the agent's random generator.
+        """
+        self.environment = environment
+        self.rollouts = rollouts
+        self.depth = depth
+        self.gamma = gamma
+        self.prior = prior
+        self.rollout_epsilon = rollout_epsilon
+        self.rng = random.Random(seed)
+        game = environment.game
+        # the simulator draws its own apples from the agent's generator, and
+        # rewards and ends episodes like the environment
+        self.simulator = environment.clone(
+            SnakeGame(grid_size=game.grid_size, seed=self.rng.getrandbits(32)))
+
+    def act(self, state, actions, ignore_exploration=True):
+        """
+        Return the action with the best mean rollout return from the current
+        board of the environment, which `state` must be the observation of.
+        """
+        if len(actions) == 1:
+            return actions[0]
+        snapshot = self.environment.game.snapshot(rng=False)
+        returns = [sum(self._rollout(snapshot, action)
+                       for _ in range(self.rollouts)) for action in actions]
+        return actions[returns.index(max(returns))]
+
+    def _rollout(self, snapshot, action):
+        simulator = self.simulator
+        simulator.game.restore(snapshot)
+        # same board, so the same frame for symmetric observations, and the
+        # same episode so far for the timeout and loop detection
+        simulator.symmetry = self.environment.symmetry
+        simulator.step_count = self.environment.step_count
+        if simulator.on_loop is not None:
+            simulator.seen_hashes = set(self.environment.seen_hashes)
+        state, reward, actions, done, _ = simulator.step(action)
+        value = reward
+        discount = 1.0
+        for _ in range(self.depth - 1):
+            if done:
+                return value
+            discount *= self.gamma
+            if self.prior is None or self.rng.random() < self.rollout_epsilon:
+                action = self.rng.choice(actions)
+            else:
+                action = self.prior.act(state, actions, True)
+            state, reward, actions, done, _ = simulator.step(action)
+            value += discount * reward
+        if not done and self.prior is not None:
+            value += discount * self.gamma * \
+                self.prior.q_table.max_q_value(state, actions)
+        return value
+
+
+class NetworkQAgent(Agent):
+    """
+    Q-learning with the Q-function approximated by a NumPy QNetwork over the
+    observations of SnakeEnvironment(features=True). Its memory is the
+    network and the replay buffer, whatever the size of the grid or of the
+    state space.
+
+    Every `train` call runs `updates_per_train` minibatch steps of Huber
+    loss on TD targets from a target network, synced every `target_sync`
+    steps. Rewards are multiplied by `reward_scale` to keep the targets
+    near 1.
+    """
+    def __init__(self, inputs=FEATURE_SIZE, hidden=(64,), learning_rate=1e-3, gamma=0.9, epsilon=0.5,
+                 epsilon_decay=0.995, minimum_epsilon=0.01, buffer_size=100000, batch_size=256,
+                 updates_per_train=8, target_sync=200, reward_scale=0.01, seed=None):
+        """
+        Args:
+            inputs (int): Number of features of an observation.
+            hidden (tuple): Hidden layer widths; () for a linear model.
+            learning_rate (float): Adam learning rate.
+            gamma (float): Discount factor.
+            epsilon (float): Exploration rate.
+            buffer_size (int): Capacity of the FeatureReplayBuffer.
+            batch_size (int): Experiences per minibatch step.
+            updates_per_train (int): Minibatch steps per `train` call.
+            target_sync (int): Minibatch steps between target network syncs.
+            reward_scale (float): Factor applied to the rewards.
+            seed (int): Seed of the weights, the buffer and the exploration.
+        """
+        self.learning_rate = learning_rate
+        self.gamma = gamma
+        self.epsilon = epsilon
+        self.epsilon_decay = epsilon_decay
+        self.minimum_epsilon = minimum_epsilon
+        self.batch_size = batch_size
+        self.updates_per_train = updates_per_train
+        self.target_sync = target_sync
+        self.reward_scale = reward_scale
+        self.rng = random.Random(seed)
+        self.network = QNetwork(inputs, hidden, len(ACTIONS), seed)
+        self.target_network = QNetwork(inputs, hidden, len(ACTIONS))
+        self.target_network.copy_from(self.network)
+        self.buffer = FeatureReplayBuffer(buffer_size, inputs, seed)
+
+    def act(self, state, actions, ignore_exploration=False):
+        """
+        Choose an action based on epsilon-greedy policy over the network's
+        Q-values of the feature array `state`.
+        """
+        if not ignore_exploration and self.rng.random() < max(self.minimum_epsilon, self.epsilon):
+            return self.rng.choice(actions)
+        q_values = self.network.forward(state[None])[0]
+        if len(actions) == len(ACTIONS):
+            return ACTIONS[int(q_values.argmax())]
+        return max(actions, key=lambda action: q_values[ACTION_INDEX[action]])
+
+    def act_batch(self, states):
+        """
+        Return the greedy action index of every row of an (N, features) array.
+        """
+        return self.network.forward(states).argmax(axis=1)
+
+    def store_experience(self, state, action, reward, next_state, done):
+        self.buffer.append((state, action, reward, next_state, done))
+
+    def update(self, state, action, reward, next_state, next_actions, weight=1.0):
+        """
+        One gradient step on a single experience.
+        Returns:
+            float: The TD error before the update, in scaled reward units.
+        """
+        batch = ReplayBatch(None, state[None], np.array([ACTION_INDEX[action]]),
+                            np.array([reward], dtype=np.float32), next_state[None],
+                            np.array([not next_actions]), np.array([weight], dtype=np.float32))
+        return float(self.update_batch(batch)[0])
+
+    def update_batch(self, batch):
+        """
+        One Adam step of Huber loss over a ReplayBatch of feature rows.
+        Returns:
+            np.ndarray: The TD error of every experience before the update.
+        """
+        max_next_q_values = np.where(batch.dones, 0,
+                                     self.target_network.forward(batch.next_states).max(axis=1))
+        td_targets = batch.rewards * self.reward_scale + self.gamma * max_next_q_values
+        q_values, activations = self.network.forward(batch.states, keep_activations=True)
+        rows = np.arange(len(batch.actions))
+        td_deltas = td_targets - q_values[rows, batch.actions]
+
+        output_gradient = np.zeros_like(q_values)
+        output_gradient[rows, batch.actions] = \
+            -np.clip(td_deltas, -1, 1) * batch.weights / len(rows)
+        self.network.apply_gradients(self.network.gradients(activations, output_gradient),
+                                     self.learning_rate)
+        if self.network.steps % self.target_sync == 0:
+            self.target_network.copy_from(self.network)
+        return td_deltas
+
+    def train(self):
+        """
+        Run `updates_per_train` minibatch steps from the replay buffer.
+        """
+        if len(self.buffer) < self.batch_size:
+            return
+        for _ in range(self.updates_per_train):
+            self.update_batch(self.buffer.sample(self.batch_size))
+        self.epsilon *= self.epsilon_decay
+        instrumentation.trace("epsilon:", max(self.minimum_epsilon, self.epsilon))
+
+    def save(self, filename):
+        """
+        Save the network weights and layer sizes with numpy.savez.
+        """
+        with open(filename, 'wb') as f:
+            np.savez(f, hidden=np.array(self.network.hidden, dtype=np.int64),
+                     *self.network.params)
+
+    def load(self, filename):
+        with np.load(filename) as model:
+            params = [model[f"arr_{i}"] for i in range(len(model.files) - 1)]
+            self.network = QNetwork(params[0].shape[0], tuple(model["hidden"]), params[-1].shape[0])
+        for param, value in zip(self.network.params, params):
+            np.copyto(param, value)
+        self.target_network = QNetwork(params[0].shape[0], self.network.hidden, params[-1].shape[0])
+        self.target_network.copy_from(self.network)
@@ -0,0 +1,435 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+import numpy as np
+
+from agents import QLearningAgent
+from constants import LastHappening
+from encoders import ENCODERS
+from environments import SnakeEnvironment
+from game import SnakeGame
+from q_tables import (ACTIONS, VOCABULARIES, BoundedQTable, DenseQTable,
+                      DictQTable)
+from replay_buffers import ReplayBuffer
+from train_agent import quiet_stdout, train_agent
+
+# -----------------------------------------------------------------------
+# Speed benchmarks of the simulation, observation and learning hot paths.
+#
+#   python benchmarks.py run -o after.json
+#   python benchmarks.py compare before.json after.json --threshold 0.1
+#   python benchmarks.py converge --target 10 --n-steps 3 --lambdas 0.8
+#
+# Every benchmark is seeded and runs a fixed number of operations `repeat`
+# times; results record the best and median operations per second. Only
+# the measured calls are timed, setup such as placing a snake is not.
+#
+# `converge` measures learning instead of speed: the episodes and seconds
+# agents with one-step, n-step and λ-returns train before their average
+# snake length over a window of episodes reaches a target.
+# -----------------------------------------------------------------------
+
+GRID_SIZES = (10, 30, 100)
+SNAKE_LENGTHS = (3, 30, 300)
+TABLE_SIZES = (100, 1000, 14641)
+BACKENDS = ("dict", "dense", "bounded")
+
+
+def _place_snake(game, length):
+    """
+    Lays a snake of `length` segments in a serpentine from the top left
+    corner, head last, and places new apples around it. SnakeGame.reset
+    rebuilds the free cells, vision index and hash of the new board.
+    """
+    grid_size = game.grid_size
+    path = [(x, y if x % 2 == 0 else grid_size - 1 - y)
+            for x in range(grid_size) for y in range(grid_size)][:length]
+    game.reset(body=reversed(path))
+    game.last_happening = LastHappening.NONE
+
+
+def _filled_q_table(backend, size, rng):
+    vocabulary = VOCABULARIES["depth"]
+    states = [vocabulary.states[i] for i in
+              rng.choice(vocabulary.size - 1, size, replace=False)]
+    values = rng.normal(size=(size, len(ACTIONS))).tolist()
+    q_values = {state: dict(zip(ACTIONS, row))
+                for state, row in zip(states, values)}
+    if backend == "dense":
+        return DenseQTable.from_dict(q_values, vocabulary), states
+    if backend == "bounded":
+        q_table = BoundedQTable(max_entries=size)
+        q_table.load_dict(q_values)
+        return q_table, states
+    return DictQTable(q_values), states
+
+
+def bench_game_step(grid_size, length, operations, seed):
+    game = SnakeGame(grid_size=grid_size)
+    actions = [ACTIONS[i] for i in
+               np.random.default_rng(seed).integers(0, 4, operations)]
+    clock = time.perf_counter
+
+    def run():
+        random.seed(seed)
+        _place_snake(game, length)
+        elapsed = 0.0
+        for action in actions:
+            start = clock()
+            game.step(action)
+            elapsed += clock() - start
+            if game.game_over:
+                _place_snake(game, length)
+        return elapsed
+    return run
+
+
+def bench_interpret(grid_size, length, operations, seed, raw_vision=False):
+    random.seed(seed)
+    game = SnakeGame(grid_size=grid_size)
+    _place_snake(game, length)
+    environment = SnakeEnvironment(game, raw_vision=raw_vision)
+    data = game.get_data()
+
+    def run():
+        start = time.perf_counter()
+        for _ in range(operations):
+            environment.interpret(*data)
+        return time.perf_counter() - start
+    return run
+
+
+def bench_encoder(encoder, grid_size, length, operations, seed,
+                  packed=False):
+    random.seed(seed)
+    game = SnakeGame(grid_size=grid_size)
+    _place_snake(game, length)
+    environment = SnakeEnvironment(game, encoder=encoder, packed=packed)
+    rich_vision = environment.interpret(*game.get_data())[1]
+    encode = environment.encode
+
+    def run():
+        start = time.perf_counter()
+        for _ in range(operations):
+            encode(rich_vision)
+        return time.perf_counter() - start
+    return run
+
+
+def bench_agent(method, backend, size, operations, seed):
+    rng = np.random.default_rng(seed)
+    q_table, states = _filled_q_table(backend, size, rng)
+    agent = QLearningAgent(q_table=q_table, batch_size=32)
+    picks = rng.integers(0, size, (max(operations, 1000), 2)).tolist()
+    transitions = [(states[i], ACTIONS[j % 4], -5.0, states[j], False)
+                   for i, j in picks]
+    actions = list(ACTIONS)
+
+    if method == "act":
+        def run():
+            start = time.perf_counter()
+            for state, *_ in transitions[:operations]:
+                agent.act(state, actions, True)
+            return time.perf_counter() - start
+    elif method == "update":
+        def run():
+            start = time.perf_counter()
+            for state, action, reward, next_state, _ in \
+                    transitions[:operations]:
+                agent.update(state, action, reward, next_state, actions)
+            return time.perf_counter() - start
+    else:
+        if method == "train_replay":
+            # the vectorized update_batch path: a ReplayBuffer sharing the
+            # DenseQTable's vocabulary
+            agent.buffer = ReplayBuffer(1000, q_table.vocabulary, seed=seed)
+            for transition in transitions[:1000]:
+                agent.buffer.append(transition)
+        else:
+            agent.buffer = deque(transitions[:1000], maxlen=1000)
+
+        def run():
+            random.seed(seed)
+            start = time.perf_counter()
+            for _ in range(operations):
+                agent.train()
+            return time.perf_counter() - start
+    return run
+
+
+def bench_load(extension, size, operations, seed, directory):
+    backend = "dense" if extension == ".l2sq" else "dict"
+    q_table, _ = _filled_q_table(backend, size, np.random.default_rng(seed))
+    filename = os.path.join(directory, f"model_{size}{extension}")
+    QLearningAgent(q_table=q_table).save(filename)
+    agent = QLearningAgent(q_table=DenseQTable(VOCABULARIES["depth"])
+                           if backend == "dense" else DictQTable())
+
+    def run():
+        start = time.perf_counter()
+        for _ in range(operations):
+            agent.load(filename)
+        return time.perf_counter() - start
+    return run
+
+
+def suite(grid_sizes, lengths, table_sizes, scale, seed, directory):
+    """
+    Yields (name, params, operations, run) for every benchmark, `run`
+    returning the seconds spent on `operations` operations.
+    """
+    def count(operations):
+        return max(1, int(operations * scale))
+
+    for grid_size in grid_sizes:
+        for length in lengths:
+            if length > grid_size * grid_size // 2:
+                continue
+            params = {"grid_size": grid_size, "snake_length": length}
+            yield ("game.step", params, count(20000),
+                   bench_game_step(grid_size, length, count(20000), seed))
+            yield ("environment.interpret", params, count(20000),
+                   bench_interpret(grid_size, length, count(20000), seed))
+            yield ("environment.interpret_raw", params, count(2000),
+                   bench_interpret(grid_size, length, count(2000), seed,
+                                   raw_vision=True))
+            for encoder in ENCODERS:
+                for packed in (False, True):
+                    yield ("environment.encode",
+                           dict(params, encoder=encoder, packed=packed),
+                           count(20000),
+                           bench_encoder(encoder, grid_size, length,
+                                         count(20000), seed, packed))
+    for backend in BACKENDS:
+        for size in table_sizes:
+            params = {"backend": backend, "table_size": size}
+            methods = [("act", 20000), ("update", 20000), ("train", 200)]
+            if backend == "dense":
+                methods.append(("train_replay", 200))
+            for method, operations in methods:
+                yield (f"agent.{method}", params, count(operations),
+                       bench_agent(method, backend, size, count(operations),
+                                   seed))
+    for extension in (".pkl", ".l2sq"):
+        for size in table_sizes:
+            yield ("agent.load", {"format": extension[1:], "table_size": size},
+                   count(20), bench_load(extension, size, count(20), seed,
+                                         directory))
+
+
+def episodes_to_length(options, seed, grid_size=10, target=10.0, window=50,
+                       max_episodes=5000, max_steps=200):
+    """
+    Trains a QLearningAgent with `options` (n_step or trace_lambda) on a
+    DenseQTable until the mean snake length of the last `window` episodes
+    reaches `target`.
+    Returns:
+        tuple: Episodes and seconds it took, episodes None if it did not
+            within `max_episodes`.
+    """
+    random.seed(seed)
+    environment = SnakeEnvironment(SnakeGame(grid_size=grid_size),
+                                   max_steps_per_episode=max_steps)
+    agent = QLearningAgent(alpha=0.1, gamma=0.9, epsilon=0.9,
+                           epsilon_decay=0.99, minimum_epsilon=0.02,
+                           buffer_size=16000, batch_size=256,
+                           q_table=DenseQTable(VOCABULARIES["depth"]),
+                           **options)
+    lengths = deque(maxlen=window)
+    start = time.perf_counter()
+    with quiet_stdout():
+        for episode in range(max_episodes):
+            lengths.extend(train_agent(agent, environment, 1))
+            if len(lengths) == window and sum(lengths) / window >= target:
+                return episode + 1, time.perf_counter() - start
+    return None, time.perf_counter() - start
+
+
+def run_convergence(n_steps=(3,), lambdas=(0.8,), seeds=3, **kwargs):
+    """
+    Runs episodes_to_length for one-step returns and every n-step and
+    λ-return setting, on seeds 0 to `seeds` - 1.
+    Returns:
+        dict: Per setting, the episodes and seconds of every seed and their
+            means over the seeds that reached the target.
+    """
+    settings = {"one-step": {}}
+    settings.update({f"n_step={n}": {"n_step": n} for n in n_steps})
+    settings.update({f"lambda={trace_lambda}": {"trace_lambda": trace_lambda}
+                     for trace_lambda in lambdas})
+    results = {}
+    for name, options in settings.items():
+        runs = [episodes_to_length(options, seed, **kwargs)
+                for seed in range(seeds)]
+        reached = [(episodes, seconds) for episodes, seconds in runs
+                   if episodes is not None]
+        results[name] = {
+            "episodes": [episodes for episodes, _ in runs],
+            "seconds": [seconds for _, seconds in runs],
+            "mean_episodes": float(np.mean([e for e, _ in reached]))
+            if reached else None,
+            "mean_seconds": float(np.mean([s for _, s in reached]))
+            if reached else None,
+        }
+        result = results[name]
+        summary = "never reached the target" if not reached else \
+            f"{result['mean_episodes']:>8.0f} episodes" \
+            f"{result['mean_seconds']:>8.2f} s"
+        print(f"{name:<20}{summary}  ({len(reached)}/{seeds} seeds)")
+    return results
+
+
+def result_key(name, params):
+    return name + "[" + ",".join(f"{key}={value}" for key, value
+                                 in params.items()) + "]"
+
+
+def run_suite(grid_sizes=GRID_SIZES, lengths=SNAKE_LENGTHS,
+              table_sizes=TABLE_SIZES, repeat=5, scale=1.0, seed=0,
+              only=None):
+    """
+    Runs every benchmark `repeat` times.
+
+    Args:
+        grid_sizes, lengths, table_sizes: The parameter grid.
+        repeat (int): Timed runs of every benchmark.
+        scale (float): Multiplies the operation counts, < 1 for quick runs.
+        seed (int): Seed of every benchmark.
+        only (str): Only run benchmarks whose name contains it.
+    Returns:
+        dict: "meta" describing the run and "results" mapping every
+            benchmark key to its ops_per_second (best run), median, and
+            operations.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, params, operations, run in suite(
+                grid_sizes, lengths, table_sizes, scale, seed, directory):
+            if only is not None and only not in name:
+                continue
+            run()  # warm up
+            times = sorted(run() for _ in range(repeat))
+            key = result_key(name, params)
+            results[key] = {
+                "name": name, "params": params, "operations": operations,
+                "ops_per_second": operations / times[0],
+                "median_ops_per_second": operations / times[len(times) // 2],
+            }
+            print(f"{key:<84}{results[key]['ops_per_second']:>14,.0f} ops/s")
+    return {"meta": _metadata(seed, repeat, scale), "results": results}
+
+
+def _metadata(seed, repeat, scale):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                                capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(),
+            "numpy": np.__version__, "machine": platform.machine(),
+            "processor": platform.processor(), "seed": seed,
+            "repeat": repeat, "scale": scale,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def compare(baseline, candidate, threshold=0.1):
+    """
+    Compares the best ops_per_second of the benchmarks two runs share.
+    Returns:
+        list: (key, baseline ops/s, candidate ops/s, ratio) of every
+            benchmark more than `threshold` slower in `candidate`.
+    """
+    regressions = []
+    shared = [key for key in baseline["results"] if key in candidate["results"]]
+    for key in shared:
+        before = baseline["results"][key]["ops_per_second"]
+        after = candidate["results"][key]["ops_per_second"]
+        ratio = after / before
+        flag = ""
+        if ratio < 1 - threshold:
+            flag = "REGRESSION"
+            regressions.append((key, before, after, ratio))
+        elif ratio > 1 + threshold:
+            flag = "faster"
+        print(f"{key:<84}{before:>14,.0f}{after:>14,.0f}{ratio:>8.2f}x "
+              f"{flag}")
+    print(f"{len(shared)} benchmarks compared, {len(regressions)} "
+          f"regressions beyond {threshold:.0%}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Speed benchmarks.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", help="JSON file of the results")
+    run_parser.add_argument("--grid-sizes", type=int, nargs="+",
+                            default=GRID_SIZES)
+    run_parser.add_argument("--snake-lengths", type=int, nargs="+",
+                            default=SNAKE_LENGTHS)
+    run_parser.add_argument("--table-sizes", type=int, nargs="+",
+                            default=TABLE_SIZES)
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--scale", type=float, default=1.0,
+                            help="multiplies the operation counts")
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--only", help="only run benchmarks whose name "
+                                           "contains this")
+    compare_parser = commands.add_parser(
+        "compare", help="flag regressions between two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.1,
+                                help="relative slowdown flagged")
+    converge_parser = commands.add_parser(
+        "converge", help="episodes to reach a snake length per return type")
+    converge_parser.add_argument("-o", "--output",
+                                 help="JSON file of the results")
+    converge_parser.add_argument("--n-steps", type=int, nargs="*",
+                                 default=[3])
+    converge_parser.add_argument("--lambdas", type=float, nargs="*",
+                                 default=[0.8])
+    converge_parser.add_argument("--seeds", type=int, default=3)
+    converge_parser.add_argument("--grid-size", type=int, default=10)
+    converge_parser.add_argument("--target", type=float, default=10.0,
+                                 help="average snake length to reach")
+    converge_parser.add_argument("--window", type=int, default=50,
+                                 help="episodes averaged")
+    converge_parser.add_argument("--max-episodes", type=int, default=5000)
+    converge_parser.add_argument("--max-steps", type=int, default=200,
+                                 help="steps per episode")
+    arguments = parser.parse_args()
+
+    if arguments.command == "run":
+        report = run_suite(arguments.grid_sizes, arguments.snake_lengths,
+                           arguments.table_sizes, arguments.repeat,
+                           arguments.scale, arguments.seed, arguments.only)
+        if arguments.output:
+            with open(arguments.output, 'w') as f:
+                json.dump(report, f, indent=2)
+    elif arguments.command == "converge":
+        report = run_convergence(
+            arguments.n_steps, arguments.lambdas, arguments.seeds,
+            grid_size=arguments.grid_size, target=arguments.target,
+            window=arguments.window, max_episodes=arguments.max_episodes,
+            max_steps=arguments.max_steps)
+        if arguments.output:
+            with open(arguments.output, 'w') as f:
+                json.dump(report, f, indent=2)
+    else:
+        with open(arguments.baseline) as f:
+            baseline = json.load(f)
+        with open(arguments.candidate) as f:
+            candidate = json.load(f)
+        if compare(baseline, candidate, arguments.threshold):
+            sys.exit(1)
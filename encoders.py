@@ -0,0 +1,120 @@
+from vision import GREEN, RED, WALL, SNAKE
+
+# -----------------------------------------------------------------------
+# Observation encoders of SnakeEnvironment, selected by name.
+#
+# An encoder turns the rich vision (per direction, the distances to the
+# nearest green, red, wall and snake) into one token per direction, found
+# in a lookup table indexed by the nearest object and its distance. The
+# four token codes are packed into one integer, most significant direction
+# first in base len(tokens): the ID of the state in the encoder's
+# StateVocabulary, which indexes a DenseQTable row directly.
+# -----------------------------------------------------------------------
+
+# every token each vision encoder can produce for one direction. The depth
+# vision order is also the one of the codes VecSnakeEnvironment computes
+DEPTH_VISION_TOKENS = ("G", "R1", "R", "W1", "W2", "W3", "W",
+                       "S1", "S2", "S3", "S")
+GRNC_VISION_TOKENS = ("G", "R", "N", "C")
+GRWC_VISION_TOKENS = ("G", "R", "W", "S", "C")
+
+# distances past this one all encode the same
+MAX_DISTANCE = 4
+
+
+class Encoder:
+    def __init__(self, name, tokens, token_of, directions=4):
+        """
+        Args:
+            name (str): Registry name, also the name of its vocabulary.
+            tokens (tuple): Every token it produces, in code order.
+            token_of: Function (kind, distance) -> token of the nearest
+                object of a direction, distances capped at MAX_DISTANCE.
+            directions (int): Directions per observation.
+        """
+        self.name = name
+        self.tokens = tokens
+        self.directions = directions
+        self.radix = len(tokens)
+        self.terminal = self.radix ** directions
+        # codes[kind][distance]; distance 0 never happens
+        self.codes = [[tokens.index(token_of(kind, max(1, distance)))
+                       for distance in range(MAX_DISTANCE + 1)]
+                      for kind in (GREEN, RED, WALL, SNAKE)]
+
+    def pack(self, rich_vision):
+        """
+        Returns the packed integer state of a rich vision.
+        """
+        codes = self.codes
+        radix = self.radix
+        state = 0
+        for green, red, wall, snake in rich_vision:
+            # nearest object, ties going to the lowest kind
+            distance, kind = wall, WALL
+            if snake is not None and snake < distance:
+                distance, kind = snake, SNAKE
+            if red is not None and red <= distance:
+                distance, kind = red, RED
+            if green is not None and green <= distance:
+                distance, kind = green, GREEN
+            state = state * radix + \
+                codes[kind][distance if distance < MAX_DISTANCE
+                            else MAX_DISTANCE]
+        return state
+
+    def unpack(self, state):
+        """
+        Returns the token tuple of a packed state, or "terminal".
+        """
+        if state == self.terminal:
+            return "terminal"
+        tokens = []
+        for _ in range(self.directions):
+            state, code = divmod(state, self.radix)
+            tokens.append(self.tokens[code])
+        return tuple(reversed(tokens))
+
+
+def _depth_token(kind, distance):
+    # green at any distance, red next to the head or further, walls and
+    # the snake at distance 1, 2, 3 or more
+    if kind == GREEN:
+        return "G"
+    if kind == RED:
+        return "R1" if distance == 1 else "R"
+    letter = "W" if kind == WALL else "S"
+    return letter + str(distance) if distance < MAX_DISTANCE else letter
+
+
+def _grnc_token(kind, distance):
+    # green, red next to the head, collision next to the head, or nothing
+    if kind == GREEN:
+        return "G"
+    if distance == 1:
+        return "R" if kind == RED else "C"
+    return "N"
+
+
+def _grwc_token(kind, distance):
+    # the nearest object, or collision if a wall or the snake is adjacent
+    if distance == 1 and kind in (WALL, SNAKE):
+        return "C"
+    return "GRWS"[kind]
+
+
+ENCODERS = {
+    encoder.name: encoder for encoder in (
+        Encoder("depth", DEPTH_VISION_TOKENS, _depth_token),
+        Encoder("GRNC", GRNC_VISION_TOKENS, _grnc_token),
+        Encoder("GRWC", GRWC_VISION_TOKENS, _grwc_token),
+    )
+}
+
+
+def get_encoder(name):
+    encoder = ENCODERS.get(name)
+    if encoder is None:
+        raise ValueError(f"Unknown encoder {name!r}, expected one of "
+                         f"{', '.join(ENCODERS)}")
+    return encoder
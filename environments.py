@@ -1,4 +1,9 @@
+import numpy as np
+
 from constants import LastHappening, Directions
+from encoders import DEPTH_VISION_TOKENS, get_encoder
+from q_tables import VOCABULARIES
+from symmetries import IDENTITY, canonical_ids, from_canonical_action
 
 # -----------------------------------------------------------------------
 # Objects with `reset`, `step(action)`, and optionally `render` methods.
@@ -12,134 +17,161 @@ def convert_nested_list_to_tuple(obj):
     return obj
 
 
+# directions times object kinds, and the snake length
+FEATURE_SIZE = 4 * 4 + 1
+
+
 # wrapper for our SnakeGame class
 class SnakeEnvironment:
     # all moves always available. possible improvement is to limit
     # available moves to avoid going back or even to avoid hitting the wall
     possible_actions = list(Directions)
 
-    def __init__(self, snake_game, max_steps_per_episode=None):
+    def __init__(self, snake_game, max_steps_per_episode=None,
+                 raw_vision=False, recorder=None, symmetric=False,
+                 encoder="depth", packed=False, on_loop=None,
+                 loop_reward=None, features=False, rewards=None):
+        """
+        Args:
+            encoder (str): Name of the observation encoder in ENCODERS.
+            packed (bool): Observe the encoder's packed integer states,
+                which are also their StateVocabulary IDs, instead of token
+                tuples. The terminal state is the vocabulary's terminal_id.
+            on_loop (str): What to do when the board repeats a
+                configuration of the episode exactly, found by its Zobrist
+                hash: "end" the episode like a timeout, "penalize" the step,
+                or nothing if None.
+            loop_reward (float): Reward of a looping step, the DIED reward
+                by default.
+            features (bool): Observe the float32 array of `get_features`
+                instead of an encoded state, for function approximation.
+                Terminal states are all zeros.
+            rewards (dict): {LastHappening: reward} overriding the rewards
+                of LastHappening.reward; timeouts get the DIED one.
+        """
+        if features and symmetric:
+            raise ValueError("Feature observations have no symmetric form")
+        if on_loop not in (None, "end", "penalize"):
+            raise ValueError(f"Unknown on_loop {on_loop!r}, expected "
+                             f"'end', 'penalize' or None")
         self.game = snake_game
         self.max_steps = max_steps_per_episode
         self.step_count = 0
+        # walk the rays cell by cell to also build the printable raw vision,
+        # instead of asking the game's VisionIndex
+        self.raw_vision = raw_vision
+        # optional TrajectoryRecorder every transition is streamed to
+        self.recorder = recorder
+        self.state = None
+        # observe canonical states under the board symmetries, and take
+        # actions in the frame of the canonical state
+        self.symmetric = symmetric
+        self.symmetry = IDENTITY
+        self.encoder = get_encoder(encoder)
+        self.vocabulary = VOCABULARIES[self.encoder.name]
+        self.packed = packed
+        self.terminal = self.vocabulary.terminal_id if packed else "terminal"
+        self.features = features
+        if features:
+            self.terminal = np.zeros(FEATURE_SIZE, dtype=np.float32)
+        if symmetric:
+            self.canonical_ids, self.symmetries = \
+                canonical_ids(self.vocabulary)
+        self.rewards = {happening: happening.reward()
+                        for happening in LastHappening}
+        self.rewards.update(rewards or {})
+        self.on_loop = on_loop
+        self.loop_reward = self.rewards[LastHappening.DIED] \
+            if loop_reward is None else loop_reward
+        # board hashes of the episode, and whether the last step repeated one
+        self.seen_hashes = set()
+        self.looped = False
+
+    def clone(self, game):
+        """
+        Returns a SnakeEnvironment of `game` with the same observation,
+        reward and termination settings as this one, and no recorder.
+        """
+        return SnakeEnvironment(
+            game, self.max_steps, raw_vision=self.raw_vision,
+            symmetric=self.symmetric, encoder=self.encoder.name,
+            packed=self.packed, on_loop=self.on_loop,
+            loop_reward=self.loop_reward, features=self.features,
+            rewards=self.rewards)
 
     def reset(self):
         self.game.reset()
         self.step_count = 0
-        return self.get_game_data()
+        self.seen_hashes = {self.game.hash}
+        self.looped = False
+        data = self.get_game_data()
+        self.state = data[0]
+        return data
 
     def step(self, action):
         # print(action.name)
-        self.game.step(action)
+        if self.symmetric:
+            self.game.step(from_canonical_action(action, self.symmetry))
+        else:
+            self.game.step(action)
         self.step_count += 1
         state, reward, actions, done, stats = self.get_game_data()
+        timed_out = False
         if self.max_steps and self.step_count >= self.max_steps:
             # optional timeout condition: if the agent takes too long,
             # end the episode with a negative reward
-            reward = LastHappening.DIED.reward()
+            reward = self.rewards[LastHappening.DIED]
+            timed_out = not done
             done = True
+        if self.on_loop is not None and not self.game.game_over:
+            hash_count = len(self.seen_hashes)
+            self.seen_hashes.add(self.game.hash)
+            self.looped = len(self.seen_hashes) == hash_count
+            if self.looped:
+                reward = self.loop_reward
+                if self.on_loop == "end":
+                    # recorded like a timeout: truncated, not terminal
+                    timed_out = True
+                    done = True
+        if self.recorder is not None:
+            self.recorder.record(self.state, action, reward, state, done,
+                                 self.game.last_happening, timed_out)
+        self.state = state
         return state, reward, actions, done, stats
 
     def get_game_data(self):
         # converts vision to tuple and returns vision/state, reward, possible actions, done
         reward, rich_vision, raw_vision, done, snake_length = self.interpret(*self.game.get_data())
         if not done:
-            # GRWC_vision = self.get_GRWC_vision(rich_vision)
-            # GRNC_vision = self.get_GRNC_vision(rich_vision)
-            eleven_state_vision = self.get_depth_vision(rich_vision)
-            return eleven_state_vision, reward, self.possible_actions, done, snake_length
+            if self.features:
+                return self.get_features(rich_vision, snake_length), reward, self.possible_actions, done, snake_length
+            return self.encode(rich_vision), reward, self.possible_actions, done, snake_length
 
-        return "terminal", reward, self.possible_actions, done, snake_length
+        return self.terminal, reward, self.possible_actions, done, snake_length
 
-    def get_depth_vision(self, rich_vision):
+    def encode(self, rich_vision):
         '''
-        Converts rich_vision to a tuple of 11 states: Green at ANY distance,
-        Red at distance 1 and distance > 1,
-        Wall at distance 1, 2, 3, 4+, Snake at distance 1, 2, 3, 4+
+        Encodes rich_vision with the selected encoder, as a packed integer or
+        the memoized token tuple of the vocabulary.
         '''
-        depth_vision = []
-        nearest_objects = [min((value, type) for type, value
-                           in enumerate(direction) if value is not None)
-                           for direction in rich_vision]
-        # 0: green, 1: red, 2: wall, 3: snake
-        moves = "GRWS"
-        for direction in nearest_objects:
-            if moves[direction[1]] == "G":
-                depth_vision.append("G")
-            elif moves[direction[1]] == "R":
-                depth_vision.append("R1" if direction[0] == 1 else "R")
-            elif moves[direction[1]] == "W":
-                if direction[0] == 1:
-                    depth_vision.append("W1")
-                elif direction[0] == 2:
-                    depth_vision.append("W2")
-                elif direction[0] == 3:
-                    depth_vision.append("W3")
-                else:
-                    depth_vision.append("W")
-            elif moves[direction[1]] == "S":
-                if direction[0] == 1:
-                    depth_vision.append("S1")
-                elif direction[0] == 2:
-                    depth_vision.append("S2")
-                elif direction[0] == 3:
-                    depth_vision.append("S3")
-                else:
-                    depth_vision.append("S")
-        return tuple(depth_vision)
+        state_id = self.encoder.pack(rich_vision)
+        if self.symmetric:
+            self.symmetry = self.symmetries[state_id]
+            state_id = self.canonical_ids[state_id]
+        return state_id if self.packed else self.vocabulary.states[state_id]
 
-    def get_GRWC_vision(self, rich_vision):
+    def get_features(self, rich_vision, snake_length):
         '''
-        Converts rich_vision to simple_vision, which is just S, W, R, G, C (for immediate S/W collision / distance of 1)
-        rich_vision: list of lists of distances to nearest green, red, and wall/snake (length 12)
-        simple_vision: tuple of nearest object type in each direction (length 4)
+        Numeric features of rich_vision for function approximation: for every
+        direction, the inverse distance (1 next to the head, 0 if absent) to
+        the nearest green, red, wall and snake, then the snake length over
+        the number of cells. Inverse distances keep the scale of the
+        features the same on every grid size.
         '''
-        simple_vision = []
-        nearest_objects = [min((value, type) for type, value
-                           in enumerate(direction) if value is not None)
-                           for direction in rich_vision]
-        # 0: green, 1: red, 2: wall, 3: snake
-        moves = "GRWS"
-        for direction in nearest_objects:
-            simple_vision.append("C" if direction[0] == 1 and
-                                 (moves[direction[1]] == "W" or moves[direction[1]] == "S")
-                                 else moves[direction[1]])
-
-        simple_vision = tuple(simple_vision)
-        return simple_vision
-
-    def get_GRNC_vision(self, rich_vision):
-        '''
-        Green (any distance)
-        Red (distance=1)
-        Nothing (distance>1 and S/W/R)
-        Collision (distance = 1 and S/W)
-        '''
-        simple_vision = []
-        nearest_objects = [min((value, type) for type, value
-                           in enumerate(direction) if value is not None)
-                           for direction in rich_vision]
-        # 0: green, 1: red, 2: wall, 3: snake
-        moves = "GRWS"
-        for direction in nearest_objects:
-            if moves[direction[1]] == "G":
-                simple_vision.append("G")
-            elif direction[0] == 1 and moves[direction[1]] in "WS":
-                simple_vision.append("C")
-            elif moves[direction[1]] in "WSR" and direction[0] > 1:
-                simple_vision.append("N")
-            else:
-                simple_vision.append("R")
-        simple_vision = tuple(simple_vision)
-        return simple_vision
-
-    # def get_GRWC_vision(self, simple_vision):
-    #     '''
-    #     removes S/W distinction from simple_vision
-    #     '''
-    #     simplest_vision = ["W" if obj == "S" else obj for obj in simple_vision]
-
-    #     return tuple(simplest_vision)
+        features = [0.0 if distance is None else 1.0 / distance
+                    for direction in rich_vision for distance in direction]
+        features.append(snake_length / self.game.grid_size ** 2)
+        return np.array(features, dtype=np.float32)
 
     # def render(self):
     #     self.game.render()  # Optional for visualization
@@ -149,10 +181,20 @@ class SnakeEnvironment:
     def interpret(self, grid_size, last_happening, snake, green_apples,
                   red_apple, done):
         '''Interprets the SnakeGame state and last happening and returns the reward
-        and snake vision, and the unprocessed vision for printing.'''
+        and snake vision, and the unprocessed vision for printing (empty unless
+        `raw_vision` is set).'''
         if done:
-            return LastHappening.reward(last_happening), [], [], done, len(snake)
-        head = snake[0]
+            return self.rewards[last_happening], [], [], done, len(snake)
+        if self.raw_vision:
+            rich_vision, raw_vision = self.walk_rays(grid_size, snake,
+                                                     green_apples, red_apple)
+        else:
+            rich_vision, raw_vision = self.game.vision.look(snake.head), []
+        return self.rewards[last_happening], rich_vision, raw_vision, done, len(snake)
+
+    def walk_rays(self, grid_size, snake, green_apples, red_apple):
+        '''Builds the rich and raw vision by walking every ray cell by cell.'''
+        head = snake.head
         rich_vision = []
         raw_vision = []
         # for direction in [
@@ -192,7 +234,7 @@ class SnakeEnvironment:
             raw_vision.append(raw_one_directional_vision)
             rich_vision.append(rich_one_directional_vision)
 
-        return LastHappening.reward(last_happening), rich_vision, raw_vision, done, len(snake)
+        return rich_vision, raw_vision
 
     def print_raw_snake_vision(self, grid_size, head, raw_vision) -> None:
         output = [list(' ' * (grid_size + 2)) for _ in range(grid_size + 2)]
@@ -209,6 +251,251 @@ class SnakeEnvironment:
             print(''.join(row))
 
 
+class VecSnakeEnvironment:
+    '''
+    Runs `num_envs` snake games in lockstep with NumPy arrays.
+
+    Follows the rules of SnakeGame._check_interactions and returns the same
+    observation as SnakeEnvironment's "depth" encoder, so Q-tables trained on
+    either environment work on both. Boards that finish are reset
+    automatically.
+
+    Every body cell holds the tick at which the head entered it. A cell is
+    occupied while its stamp is newer than `tick - length`, so moving,
+    growing and shrinking only touch the head cell and the counters.
+    '''
+    possible_actions = list(Directions)
+    direction_vectors = np.array([direction.value for direction
+                                  in Directions])
+    rewards = np.array([happening.reward() for happening in LastHappening])
+    _empty = np.iinfo(np.int64).min // 2
+
+    def __init__(self, num_envs, grid_size=10, max_steps_per_episode=None,
+                 seed=None, decode_states=True):
+        """
+        Args:
+            decode_states (bool): Build depth vision tuples for every board.
+                Without them, step and reset return None for the states and
+                consumers read the token codes in `self.codes`.
+        """
+        if grid_size < 3:
+            raise ValueError("Grid size must be at least 3.")
+        self.num_envs = num_envs
+        self.grid_size = grid_size
+        self.max_steps = max_steps_per_episode
+        self.rng = np.random.default_rng(seed)
+        self.decode_states = decode_states
+
+        cells = grid_size * grid_size
+        self.stamps = np.full((num_envs, cells), self._empty, dtype=np.int64)
+        self.ticks = np.zeros(num_envs, dtype=np.int64)
+        self.lengths = np.zeros(num_envs, dtype=np.int64)
+        self.heads = np.zeros((num_envs, 2), dtype=np.int64)
+        self.directions = np.zeros(num_envs, dtype=np.int64)
+        self.green_apples = np.full((num_envs, 2), -1, dtype=np.int64)
+        self.red_apples = np.full(num_envs, -1, dtype=np.int64)
+        self.step_counts = np.zeros(num_envs, dtype=np.int64)
+        self.dones = np.zeros(num_envs, dtype=bool)
+
+        # offsets 1..grid_size along each direction, shape (4, grid_size, 2)
+        distances = np.arange(1, grid_size + 1)
+        self._ray_offsets = (self.direction_vectors[:, None, :] *
+                             distances[None, :, None])
+        self.codes = np.zeros((num_envs, 4), dtype=np.int64)
+        self.states = []
+
+    def reset(self):
+        '''Resets every board and returns the list of first observations.'''
+        self._reset_boards(np.arange(self.num_envs))
+        self.states = self._observe()
+        return self.states
+
+    def step(self, actions):
+        '''
+        Advances every board by one move.
+        Args:
+            actions: N action indices into `possible_actions`, or N members
+                of Directions.
+        Returns:
+            next_states (list): observation per board, "terminal" for boards
+                that died (a timed out board keeps its observation, like
+                SnakeEnvironment.step).
+            rewards (np.ndarray): reward per board.
+            dones (np.ndarray): whether the board finished its episode.
+            lengths (np.ndarray): snake length per board after the move.
+        Finished boards are reset before returning; their new first
+        observations are in `self.states`, ready for the next `act`.
+        '''
+        actions = self._action_indices(actions)
+        boards = np.arange(self.num_envs)
+        grid_size = self.grid_size
+
+        turn = (self.lengths == 1) | (actions != (self.directions + 2) % 4)
+        self.directions = np.where(turn, actions, self.directions)
+        new_heads = self.heads + self.direction_vectors[self.directions]
+        in_bounds = np.all((new_heads >= 0) & (new_heads < grid_size), axis=1)
+        cells = np.where(in_bounds,
+                         new_heads[:, 0] * grid_size + new_heads[:, 1], 0)
+
+        eaten_green = (self.green_apples == cells[:, None]) & in_bounds[:, None]
+        ate_green = eaten_green.any(axis=1)
+        ate_red = (self.red_apples == cells) & in_bounds & ~ate_green
+        # the tail has moved on, so only body[1:] after the shrink collides
+        collided = self.stamps[boards, cells] > \
+            self.ticks - self.lengths + 1
+        died = ~ate_green & ~ate_red & (~in_bounds | collided)
+        died |= ate_red & (self.lengths == 1)
+        alive = ~died
+
+        self.lengths += ate_green
+        self.lengths -= ate_red
+        self.ticks += alive
+        self.heads = np.where(alive[:, None], new_heads, self.heads)
+        self.stamps[boards[alive], cells[alive]] = self.ticks[alive]
+        final_lengths = np.where(died & ate_red, 0, self.lengths)
+
+        happenings = np.full(self.num_envs, LastHappening.NO_COLLISION.value)
+        happenings[ate_green] = LastHappening.GREEN_APPLE_EATEN.value
+        happenings[ate_red] = LastHappening.RED_APPLE_EATEN.value
+        happenings[died] = LastHappening.DIED.value
+
+        full = np.zeros(self.num_envs, dtype=bool)
+        green_rows, green_slots = np.nonzero(eaten_green & alive[:, None])
+        if len(green_rows):
+            self.green_apples[green_rows, green_slots] = -1
+            new_cells = self._random_free_cells(green_rows)
+            self.green_apples[green_rows, green_slots] = new_cells
+            full[green_rows[new_cells < 0]] = True
+        red_rows = np.nonzero(ate_red & alive)[0]
+        if len(red_rows):
+            self.red_apples[red_rows] = -1
+            new_cells = self._random_free_cells(red_rows)
+            self.red_apples[red_rows] = new_cells
+            full[red_rows[new_cells < 0]] = True
+
+        rewards = self.rewards[happenings]
+        self.step_counts += 1
+        next_states = self._observe()
+        dones = died | full
+        if self.max_steps:
+            # optional timeout condition, same as SnakeEnvironment.step
+            timed_out = self.step_counts >= self.max_steps
+            rewards = np.where(timed_out, LastHappening.DIED.reward(),
+                               rewards)
+            dones |= timed_out
+        if next_states is not None:
+            for board in np.nonzero(died | full)[0]:
+                next_states[board] = "terminal"
+
+        self.dones = dones
+        finished = np.nonzero(dones)[0]
+        if len(finished):
+            self._reset_boards(finished)
+            self.states = self._observe()
+        else:
+            self.states = next_states
+        return next_states, rewards, dones, final_lengths
+
+    def _action_indices(self, actions):
+        if len(actions) and isinstance(actions[0], Directions):
+            actions = [self.possible_actions.index(action)
+                       for action in actions]
+        actions = np.asarray(actions, dtype=np.int64)
+        if actions.shape != (self.num_envs,):
+            raise ValueError(f"Expected {self.num_envs} actions, got "
+                             f"{actions.shape}")
+        return actions
+
+    def _reset_boards(self, boards):
+        count = len(boards)
+        grid_size = self.grid_size
+        self.stamps[boards] = self._empty
+
+        # same start as Snake._generate_random_snake: a length 3 snake with
+        # room for its body behind the head
+        directions = self.rng.integers(0, 4, size=count)
+        vectors = self.direction_vectors[directions]
+        low = np.where(vectors == 1, 2, 0)
+        high = np.where(vectors == -1, grid_size - 3, grid_size - 1)
+        heads = self.rng.integers(low, high + 1)
+        for age in range(3):
+            segments = heads - age * vectors
+            self.stamps[boards, segments[:, 0] * grid_size +
+                        segments[:, 1]] = 3 - age
+
+        self.ticks[boards] = 3
+        self.lengths[boards] = 3
+        self.heads[boards] = heads
+        self.directions[boards] = directions
+        self.step_counts[boards] = 0
+
+        self.green_apples[boards] = -1
+        self.red_apples[boards] = -1
+        for slot in range(2):
+            self.green_apples[boards, slot] = self._random_free_cells(boards)
+        self.red_apples[boards] = self._random_free_cells(boards)
+
+    def _random_free_cells(self, boards):
+        '''
+        Picks a uniformly random free cell for each board in `boards`,
+        or -1 where the board has no free cell left.
+        '''
+        occupied = self.stamps[boards] > \
+            (self.ticks[boards] - self.lengths[boards])[:, None]
+        apples = np.concatenate([self.green_apples[boards],
+                                 self.red_apples[boards][:, None]], axis=1)
+        rows, slots = np.nonzero(apples >= 0)
+        occupied[rows, apples[rows, slots]] = True
+
+        scores = self.rng.random(occupied.shape)
+        scores[occupied] = -1
+        cells = scores.argmax(axis=1)
+        return np.where(scores[np.arange(len(boards)), cells] >= 0, cells, -1)
+
+    def _observe(self):
+        '''
+        Casts the four rays of SnakeEnvironment.interpret for every board at
+        once and stores the DEPTH_VISION_TOKENS code per direction in
+        `self.codes`. Returns the observations as depth vision tuples, or None
+        if `decode_states` is off.
+        '''
+        grid_size = self.grid_size
+        # (N, 4, grid_size, 2) positions along every ray
+        positions = self.heads[:, None, None, :] + self._ray_offsets[None]
+        in_bounds = np.all((positions >= 0) & (positions < grid_size), axis=3)
+        cells = np.where(in_bounds, positions[..., 0] * grid_size +
+                         positions[..., 1], 0)
+
+        boards = np.arange(self.num_envs)[:, None, None]
+        snake = self.stamps[boards, cells] > \
+            (self.ticks - self.lengths)[:, None, None]
+        green = (cells[..., None] ==
+                 self.green_apples[:, None, None, :]).any(axis=3)
+        red = cells == self.red_apples[:, None, None]
+        snake &= in_bounds
+        green &= in_bounds
+        red &= in_bounds
+
+        hit = snake | green | red
+        first = hit.argmax(axis=2)
+        any_hit = hit.any(axis=2)
+        distance = first + 1
+        first = first[..., None]
+        first_snake = np.take_along_axis(snake, first, axis=2)[..., 0]
+        first_red = np.take_along_axis(red, first, axis=2)[..., 0]
+        wall_distance = in_bounds.sum(axis=2) + 1
+
+        codes = np.where(first_snake, 6 + np.minimum(distance, 4),
+                         np.where(first_red, np.where(distance == 1, 1, 2),
+                                  0))
+        self.codes = np.where(any_hit, codes,
+                              2 + np.minimum(wall_distance, 4))
+        if not self.decode_states:
+            return None
+        return [tuple(DEPTH_VISION_TOKENS[code] for code in row)
+                for row in self.codes.tolist()]
+
+
 # testing
 # reward, vision, raw_vision = interpret(
 #     10, LastHappening.DIED, [(2, 2)], [(1, 1)], (4, 4))
@@ -1,9 +1,64 @@
-import pygame as pg
 import random
-import sys
-from time import sleep
+from collections import deque
 
+import instrumentation
 from constants import LastHappening, Directions
+from renderers import NullRenderer, PygameRenderer
+from vision import VisionIndex, GREEN, RED, SNAKE
+from zobrist import DIRECTION_INDEX, ZobristKeys
+
+
+class FreeCells:
+    """
+    The cells covered by neither the snake nor an apple. They are kept in a
+    list, with the index of every cell in that list (-1 if not free), so
+    adding, removing and uniform sampling are all O(1).
+    """
+    def __init__(self, grid_size, rng=random):
+        self.grid_size = grid_size
+        self.rng = rng
+        self.reset()
+
+    def reset(self):
+        # every cell free; cells are numbered x * grid_size + y
+        self.cells = list(range(self.grid_size ** 2))
+        self.index = list(range(self.grid_size ** 2))
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, position):
+        x, y = position
+        return 0 <= x < self.grid_size and 0 <= y < self.grid_size and \
+            self.index[x * self.grid_size + y] >= 0
+
+    def add(self, position):
+        x, y = position
+        if 0 <= x < self.grid_size and 0 <= y < self.grid_size:
+            cell = x * self.grid_size + y
+            if self.index[cell] < 0:
+                self.index[cell] = len(self.cells)
+                self.cells.append(cell)
+
+    def discard(self, position):
+        x, y = position
+        if 0 <= x < self.grid_size and 0 <= y < self.grid_size:
+            cell = x * self.grid_size + y
+            i = self.index[cell]
+            if i >= 0:
+                # move the last free cell into the hole
+                last = self.cells.pop()
+                if last != cell:
+                    self.cells[i] = last
+                    self.index[last] = i
+                self.index[cell] = -1
+
+    def sample(self):
+        # a uniformly random free cell, or None if the board is full
+        if not self.cells:
+            return None
+        return divmod(self.cells[self.rng.randrange(len(self.cells))],
+                      self.grid_size)
 
 
 class Apple:
@@ -11,37 +66,79 @@ class Apple:
         self.type = type
         self.position = (0, 0)
 
-    def relocate(self, grid_size, occupied_positions):
-        if len(occupied_positions) >= grid_size ** 2:
-            print(len(occupied_positions), occupied_positions)
-            input("NO SPACE FOR APPLES!!!")
-        while len(occupied_positions) < grid_size ** 2:
-            self.position = (random.randint(0, grid_size - 1),
-                             random.randint(0, grid_size - 1))
-            if self.position not in occupied_positions:
-                break
+    def relocate(self, free_cells):
+        # returns False, leaving the apple where it was, if no cell is free
+        position = free_cells.sample()
+        if position is None:
+            return False
+        self.position = position
+        free_cells.discard(position)
+        return True
 
 
 class Snake:
-    def __init__(self, grid_size, random_start=True):
+    """
+    The body is a deque (head first) kept in sync with a bytearray that
+    counts the segments on every grid cell, so moving, shrinking and
+    membership tests are O(1) whatever the length of the snake.
+    """
+    def __init__(self, grid_size, random_start=True, rng=random):
         self.grid_size = grid_size
+        self.rng = rng
         self.reset(grid_size, random_start)
 
-    def reset(self, grid_size, random_start=True):
+    def reset(self, grid_size, random_start=True, body=None):
+        self.grid_size = grid_size
         center = grid_size // 2
         self.input_buffer = []  # Input buffer for directional input
-        if random_start:
-            self.body = self._generate_random_snake()
+        if body is not None:
+            # given segments, head first
+            self.body = deque(body)
+            self.direction = self._get_direction()
+        elif random_start:
+            self.body = deque(self._generate_random_snake())
             self.direction = self._get_direction()
         else:
-            self.body = [(2, center), (1, center), (0, center)]
+            self.body = deque([(2, center), (1, center), (0, center)])
             self.direction = Directions.RIGHT  # Initially moving right
+        self.occupancy = bytearray(grid_size * grid_size)
+        for segment in self.body:
+            self._mark(segment, 1)
+
+    def __len__(self):
+        return len(self.body)
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def __contains__(self, position):
+        x, y = position
+        return 0 <= x < self.grid_size and 0 <= y < self.grid_size and \
+            self.occupancy[x * self.grid_size + y] > 0
+
+    @property
+    def head(self):
+        return self.body[0]
+
+    def _mark(self, position, count):
+        # segments outside the grid (a head that hit the wall) are not tracked
+        x, y = position
+        if 0 <= x < self.grid_size and 0 <= y < self.grid_size:
+            self.occupancy[x * self.grid_size + y] += count
+
+    def is_head_on_body(self):
+        """
+        True if the head shares its cell with another segment.
+        """
+        x, y = self.body[0]
+        return 0 <= x < self.grid_size and 0 <= y < self.grid_size and \
+            self.occupancy[x * self.grid_size + y] > 1
 
     def _generate_random_snake(self):
         """
         Generate a random contiguous starting position for snake of length 3.
         """
-        initial_direction = random.choice(list(Directions))
+        initial_direction = self.rng.choice(list(Directions))
 
         min_x, max_x = 0, self.grid_size - 1
         min_y, max_y = 0, self.grid_size - 1
@@ -58,8 +155,8 @@ class Snake:
             min_y = 0
             max_y = self.grid_size - 3
 
-        start_x = random.randint(min_x, max_x)
-        start_y = random.randint(min_y, max_y)
+        start_x = self.rng.randint(min_x, max_x)
+        start_y = self.rng.randint(min_y, max_y)
 
         # Generate contiguous body segments
         body = [
@@ -86,18 +183,23 @@ class Snake:
         return new_direction
 
     def move(self, new_direction):
-        print("move", new_direction.name)
-        print("current direction", self.direction.name)
+        instrumentation.trace("move", new_direction.name)
+        instrumentation.trace("current direction", self.direction.name)
         if len(self.body) == 1 or \
                 not self.is_opposite_direction(new_direction):
             self.direction = new_direction
         head_x, head_y = self.body[0]
         new_head = (head_x + self.direction.value[0], head_y + self.direction.value[1])
-        self.body.insert(0, new_head)
+        self.body.appendleft(new_head)
+        self._mark(new_head, 1)
 
     def shrink(self):
+        # returns the removed tail segment, or None if there was none
         if len(self.body) > 0:
-            self.body.pop()
+            tail = self.body.pop()
+            self._mark(tail, -1)
+            return tail
+        return None
 
     def add_direction_to_buffer(self, new_direction):
         if len(self.input_buffer) < 2 and \
@@ -115,57 +217,101 @@ class Snake:
         return new_direction == opposite_directions.get(self.direction)
 
 
+class GameSnapshot:
+    """
+    Everything SnakeGame.restore needs, in flat immutable values and list
+    copies: no object graph to walk like copy.deepcopy would.
+    """
+    __slots__ = ("body", "direction", "occupancy", "green_apples",
+                 "red_apple", "free_cells", "free_index", "hash",
+                 "last_happening", "game_over", "rng_state")
+
+    def __init__(self, body, direction, occupancy, green_apples, red_apple,
+                 free_cells, free_index, hash, last_happening, game_over,
+                 rng_state):
+        self.body = body
+        self.direction = direction
+        self.occupancy = occupancy
+        self.green_apples = green_apples
+        self.red_apple = red_apple
+        self.free_cells = free_cells
+        self.free_index = free_index
+        self.hash = hash
+        self.last_happening = last_happening
+        self.game_over = game_over
+        self.rng_state = rng_state
+
+
 class SnakeGame:
-    colors = {
-        'background': (0, 0, 0),
-        'snake_body': (200, 200, 200),
-        'snake_head': (255, 255, 255),
-        'green_apple': (0, 255, 0),
-        'red_apple': (255, 0, 0)
-    }
-
-    def __init__(self, grid_size=10, random_start=True, render=True,
-                 block_size=50, margin=50):
+    """
+    The snake simulation. Drawing is left to a renderer from renderers;
+    without one the game runs headless.
+    """
+    def __init__(self, grid_size=10, random_start=True, render=False,
+                 block_size=50, margin=50, renderer=None, seed=None):
+        """
+        Args:
+            render (bool): Open a pygame window, unless `renderer` is given.
+            block_size (int): Pixel size of a cell of the pygame window.
+            margin (int): Pixel margin around the grid of the pygame window.
+            renderer: A Renderer to draw every step with.
+            seed (int): Seed of a random generator of this game alone. The
+                game draws from the global `random` module if None.
+        """
         if grid_size < 3:
             raise ValueError("Grid size must be at least 3.")
         self.random_start = random_start
         self.grid_size = grid_size
-        self.render = render
-        self.snake = Snake(grid_size, random_start)
+        self.block_size = block_size
+        self.margin = margin
+        self.rng = random if seed is None else random.Random(seed)
+        self.snake = Snake(grid_size, random_start, self.rng)
 
         # Initialize apples
+        self.free_cells = FreeCells(grid_size, self.rng)
         self.green_apples = [Apple(type='green') for _ in range(2)]
         self.red_apple = Apple(type='red')
         self._reset_apples()
+        # sorted row/column index of every object, for the snake's vision
+        self.vision = VisionIndex(grid_size)
+        self.vision.rebuild(self.snake, self.green_apples, self.red_apple)
+        # Zobrist hash of the whole board, updated with every move
+        self.zobrist = ZobristKeys(grid_size)
+        self.hash = self.zobrist.board_hash(self.snake, self.green_apples,
+                                            self.red_apple)
 
         self.last_happening = LastHappening.NONE
         self.game_over = False
-        self.block_size = block_size
-        self.margin = margin
-        # Make the window larger than the grid
-        self.screen_size = (grid_size * block_size) + 2 * margin
 
-        if self.render:
-            self._init_pygame_window()
-
-    def _init_pygame_window(self):
-        pg.init()
-        self.screen = pg.display.set_mode((self.screen_size,
-                                           self.screen_size))
-        pg.display.set_caption("Snake")
-        self.clock = pg.time.Clock()
-        self.font = pg.font.Font(None, 69)
-        # self._draw()
-        # sleep(1)
+        self.renderer = NullRenderer()
+        self.render = False
+        if renderer is not None:
+            self.set_renderer(renderer)
+        elif render:
+            self.init_rendering()
+
+    def set_renderer(self, renderer):
+        self.renderer.close()
+        self.renderer = renderer
+        self.render = not isinstance(renderer, NullRenderer)
+        renderer.open(self)
 
     def init_rendering(self):
+        # opens a pygame window, importing pygame on first use
         if not self.render:
-            self._init_pygame_window()
-        self.render = True
+            self.set_renderer(PygameRenderer(self.block_size, self.margin))
 
-    def reset(self):
-        self.snake.reset(self.grid_size, random_start=self.random_start)
+    def reset(self, body=None):
+        """
+        Starts a new game, with a snake of the given `body` segments (head
+        first, at least two, all adjacent) instead of a new one if given.
+        """
+        self.snake.reset(self.grid_size, random_start=self.random_start,
+                         body=body)
         self._reset_apples()
+        self.vision.rebuild(self.snake, self.green_apples, self.red_apple)
+        self.hash = self.zobrist.board_hash(self.snake, self.green_apples,
+                                            self.red_apple)
         self.game_over = False
 
     def step(self, move_direction):
@@ -173,136 +319,84 @@ class SnakeGame:
             raise ValueError("Game is over. Cannot take further action")
         self._update_game_state(move_direction)
         if self.render:
-            self._draw()
+            self.renderer.draw(self)
             if self.game_over:
-                self._draw_game_over()
+                self.renderer.draw_game_over(self)
+
+    def snapshot(self, rng=True):
+        """
+        Captures the state of the game, and of its random generator unless
+        `rng` is False, in a GameSnapshot to `restore` any number of times.
+        """
+        snake = self.snake
+        return GameSnapshot(
+            tuple(snake.body), snake.direction, bytes(snake.occupancy),
+            tuple(apple.position for apple in self.green_apples),
+            self.red_apple.position, self.free_cells.cells[:],
+            self.free_cells.index[:], self.hash, self.last_happening,
+            self.game_over, self.rng.getstate() if rng else None)
+
+    def restore(self, snapshot):
+        """
+        Puts the game back in the state of a GameSnapshot of a game of the
+        same grid size. The random generator is restored only if the
+        snapshot holds its state.
+        """
+        snake = self.snake
+        snake.body = deque(snapshot.body)
+        snake.direction = snapshot.direction
+        snake.occupancy = bytearray(snapshot.occupancy)
+        snake.input_buffer = []
+        for apple, position in zip(self.green_apples, snapshot.green_apples):
+            apple.position = position
+        self.red_apple.position = snapshot.red_apple
+        self.free_cells.cells = snapshot.free_cells[:]
+        self.free_cells.index = snapshot.free_index[:]
+        self.vision.rebuild(snake, self.green_apples, self.red_apple)
+        self.hash = snapshot.hash
+        self.last_happening = snapshot.last_happening
+        self.game_over = snapshot.game_over
+        if snapshot.rng_state is not None:
+            self.rng.setstate(snapshot.rng_state)
 
     def human_play(self, fps=5):
-        if not self.render:
+        if not self.renderer.interactive:
             raise ValueError("Rendering must be enabled to play the game \
 manually.")
-        # self._draw()
-        # sleep(1)
-        self.clock.tick(fps)
+        renderer = self.renderer
+        renderer.tick(fps)
         running = True
         while running:
-            self._handle_user_events()
+            # quits the process on escape or window close
+            renderer.handle_events(self)
             if not self.game_over:
                 move_direction = self.snake.get_move_from_buffer()
                 self._update_game_state(move_direction)
-                self._draw()
+                renderer.draw(self)
                 if self.game_over:
-                    self._draw_game_over()
-            self.clock.tick(fps)
-        pg.quit()
-        sys.exit()
-
-    def _handle_user_events(self):
-        for event in pg.event.get():
-            if event.type == pg.QUIT:
-                self._quit_game()
-            elif event.type == pg.KEYDOWN:
-                self._handle_keydown(event)
-
-    def _handle_keydown(self, event):
-        if event.key == pg.K_ESCAPE:
-            self._quit_game()
-        elif event.key == pg.K_w:
-            self.snake.add_direction_to_buffer(Directions.UP)
-        elif event.key == pg.K_s:
-            self.snake.add_direction_to_buffer(Directions.DOWN)
-        elif event.key == pg.K_a:
-            self.snake.add_direction_to_buffer(Directions.LEFT)
-        elif event.key == pg.K_d:
-            self.snake.add_direction_to_buffer(Directions.RIGHT)
-        elif event.key == pg.K_SPACE and self.game_over:
-            self._restart_game()
-
-    def _quit_game(self):
-        pg.quit()
-        sys.exit()
-
-    def _restart_game(self):
-        self.reset()
-        pg.event.clear()
-        self._draw()
-        sleep(1)
-        self.clock.tick(5)
+                    renderer.draw_game_over(self)
+            renderer.tick(fps)
 
     def _update_game_state(self, move_direction):
+        keys = self.zobrist
+        old_head, old_direction = self.snake.head, self.snake.direction
         self.snake.move(move_direction)
+        head = self.snake.head
+        self.hash ^= keys.direction[DIRECTION_INDEX[old_direction]] ^ \
+            keys.direction[DIRECTION_INDEX[self.snake.direction]] ^ \
+            keys.head_key(old_head) ^ keys.head_key(head) ^ \
+            keys.segment(head, old_head)
+        self.vision.add(SNAKE, self.snake.head)
+        self.free_cells.discard(self.snake.head)
         if self._check_interactions():
             # True if the snake has died, False otherwise.
             self.last_happening = LastHappening.DIED
             self.game_over = True
 
     def get_data(self):
-        return self.grid_size, self.last_happening, self.snake.body, \
+        return self.grid_size, self.last_happening, self.snake, \
                 self.green_apples, self.red_apple, self.game_over
 
-    def _draw(self):
-        # Clear screen
-        self.screen.fill(self.colors['background'])
-
-        # Adjust drawing offset to center the grid within the window
-        grid_offset = self.margin
-
-        for segment in reversed(self.snake.body):
-            # Head is white, body is light gray
-            color = self.colors['snake_head'] if segment == self.snake.body[0]\
-                else self.colors['snake_body']
-            pg.draw.rect(self.screen, color,
-                         (grid_offset + segment[0] * self.block_size,
-                          grid_offset + segment[1] * self.block_size,
-                          self.block_size,
-                          self.block_size))
-
-        # Draw green apples (from current state)
-        for apple in self.green_apples:
-            pg.draw.rect(self.screen, self.colors['green_apple'],
-                         (grid_offset + apple.position[0] * self.block_size,
-                          grid_offset + apple.position[1] * self.block_size,
-                          self.block_size, self.block_size))
-
-        # Draw red apple (from current state)
-        pg.draw.rect(self.screen, self.colors['red_apple'],
-                     (grid_offset + self.red_apple.position[0] *
-                      self.block_size, grid_offset +
-                      self.red_apple.position[1] * self.block_size,
-                      self.block_size, self.block_size))
-
-        # Draw the grid (black lines)
-        for x in range(self.grid_size + 1):
-            pg.draw.line(self.screen, self.colors['background'],
-                         (grid_offset + x * self.block_size, grid_offset),
-                         (grid_offset + x * self.block_size,
-                          self.screen_size - self.margin))
-        for y in range(self.grid_size + 1):
-            pg.draw.line(self.screen, self.colors['background'],
-                         (grid_offset, grid_offset + y * self.block_size),
-                         (self.screen_size - self.margin, grid_offset + y *
-                          self.block_size))
-
-        # Draw bounding box (grey lines)
-        pg.draw.rect(self.screen, (150, 150, 150),
-                     (grid_offset, grid_offset,
-                      self.grid_size * self.block_size,
-                      self.grid_size * self.block_size), 1)
-
-        if not self.game_over:
-            pg.display.flip()
-
-        # this is needed to not have the OS freeze the window when rendering is True
-        pg.event.pump()
-
-    def _draw_game_over(self):
-        # Display "Game Over" message in the center
-        text = self.font.render("GAME OVER", True, (255, 200, 0))
-        text_rect = text.get_rect(center=(self.screen_size // 2,
-                                          self.screen_size // 2))
-        self.screen.blit(text, text_rect)
-        pg.display.flip()
-
     def _check_interactions(self):
         # returns True if the snake dies, False otherwise
         head = self.snake.body[0]
@@ -312,7 +406,7 @@ manually.")
             return False
 
         # Pop the tail before checking red apples and collisions
-        self.snake.shrink()
+        self._shrink_snake()
 
         # Check red apples
         if self._check_if_ate_red_apple(head):
@@ -335,10 +429,7 @@ manually.")
         # Returns True if eaten, False otherwise
         for apple in self.green_apples:
             if head == apple.position:
-                occupied_positions = set(self.snake.body +
-                                       [apple.position for apple in self.green_apples] +
-                                       [self.red_apple.position])
-                apple.relocate(self.grid_size, occupied_positions)
+                self._relocate_apple(apple, GREEN)
                 self.last_happening = LastHappening.GREEN_APPLE_EATEN
                 return True
         return False
@@ -347,11 +438,8 @@ manually.")
         # Check if eating the red apple
         # Returns True if red apple was eaten, False otherwise
         if head == self.red_apple.position:
-            occupied_positions = set(self.snake.body +
-                                   [apple.position for apple in self.green_apples] +
-                                   [self.red_apple.position])
-            self.red_apple.relocate(self.grid_size, occupied_positions)
-            self.snake.shrink()
+            self._relocate_apple(self.red_apple, RED)
+            self._shrink_snake()
             self.last_happening = LastHappening.RED_APPLE_EATEN
             return True  # Red apple was eaten (caller checks snake survival)
         return False
@@ -365,14 +453,44 @@ manually.")
             return True
 
         # Self collision
-        if head in self.snake.body[1:]:
+        if self.snake.is_head_on_body():
             return True
 
         return False
 
+    def _shrink_snake(self):
+        tail = self.snake.shrink()
+        if tail is not None:
+            # the segment before the tail becomes the tail
+            keys = self.zobrist
+            body = self.snake.body
+            self.hash ^= keys.segment(tail)
+            if body:
+                self.hash ^= keys.segment(body[-1], tail) ^ \
+                    keys.segment(body[-1])
+            else:
+                self.hash ^= keys.head_key(tail)
+            self.vision.remove(SNAKE, tail)
+            # the head may have just moved onto the cell the tail left
+            if tail not in self.snake:
+                self.free_cells.add(tail)
+
+    def _relocate_apple(self, apple, kind):
+        # the eaten apple's cell stays covered by the head
+        old_position = apple.position
+        old_key = self.zobrist.apple_key(apple)
+        if not apple.relocate(self.free_cells):
+            # the snake fills the board: end the episode cleanly
+            self.game_over = True
+            return
+        self.vision.move(kind, old_position, apple.position)
+        self.hash ^= old_key ^ self.zobrist.apple_key(apple)
+
     def _reset_apples(self):
-        occupied = set(self.snake.body)
+        # also rebuilds the free cells around the new snake
+        self.free_cells.reset()
+        for segment in self.snake:
+            self.free_cells.discard(segment)
 
         for apple in self.green_apples + [self.red_apple]:
-            apple.relocate(self.grid_size, occupied)
-            occupied.add(apple.position)
+            apple.relocate(self.free_cells)
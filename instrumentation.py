@@ -0,0 +1,152 @@
+import json
+import sys
+import time
+
+import numpy as np
+
+# -----------------------------------------------------------------------
+# Per-phase counters and timers for the training hot paths.
+#
+# Instrumentation.enable() swaps timed wrappers in for the methods of
+# PHASES and disable() puts the originals back, so a disabled run executes
+# exactly the uninstrumented code. Debug output of the hot paths goes
+# through `trace`, a no-op unless an enabled Instrumentation has
+# `trace=True`.
+# -----------------------------------------------------------------------
+
+# phase name -> (module, class, method) it times
+PHASES = {
+    "simulate": ("game", "SnakeGame", "step"),
+    "observe": ("environments", "SnakeEnvironment", "interpret"),
+    "encode": ("environments", "SnakeEnvironment", "encode"),
+    "act": ("agents", "QLearningAgent", "act"),
+    "learn": ("agents", "QLearningAgent", "train"),
+}
+
+
+def _silent(*args):
+    pass
+
+
+def _print(*args):
+    print(*args)
+
+
+trace = _silent
+
+
+class Instrumentation:
+    """
+    Times every call of the PHASES methods while enabled, and prints a
+    summary (calls, total seconds, p50 and p99 in microseconds per phase)
+    every `report_interval` seconds. Usable as a context manager.
+    """
+    def __init__(self, report_interval=None, output="text", stream=None,
+                 trace=False):
+        """
+        Args:
+            report_interval (float): Seconds between two summaries, checked
+                after every `learn` call. Only on demand with `report` if
+                None.
+            output (str): "text" or "json" summaries.
+            stream: File the summaries are written to, stdout by default.
+            trace (bool): Print the debug traces of the hot paths.
+        """
+        if output not in ("text", "json"):
+            raise ValueError(f"Unknown instrumentation output {output!r}")
+        self.report_interval = report_interval
+        self.output = output
+        self.stream = stream
+        self.trace = trace
+        self.originals = {}
+        self.durations = {phase: [] for phase in PHASES}
+        self.last_report = time.perf_counter()
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def enable(self):
+        global trace
+        if self.originals:
+            return
+        for phase, (module_name, class_name, method_name) in PHASES.items():
+            cls = getattr(__import__(module_name), class_name)
+            original = cls.__dict__[method_name]
+            self.originals[phase] = (cls, method_name, original)
+            setattr(cls, method_name, self._timed(phase, original))
+        if self.trace:
+            trace = _print
+        self.last_report = time.perf_counter()
+
+    def disable(self):
+        global trace
+        for cls, method_name, original in self.originals.values():
+            setattr(cls, method_name, original)
+        self.originals = {}
+        trace = _silent
+
+    def _timed(self, phase, method):
+        durations = self.durations[phase]
+        clock = time.perf_counter_ns
+        check_report = phase == "learn" and self.report_interval is not None
+
+        def timed(*args, **kwargs):
+            start = clock()
+            result = method(*args, **kwargs)
+            durations.append(clock() - start)
+            if check_report and time.perf_counter() - self.last_report >= \
+                    self.report_interval:
+                self.report()
+            return result
+        timed.__wrapped__ = method
+        return timed
+
+    def summary(self):
+        """
+        Returns:
+            dict: {phase: {calls, total, p50, p99}} since the last reset,
+                total in seconds and the percentiles in microseconds.
+        """
+        summary = {}
+        for phase, durations in self.durations.items():
+            if durations:
+                values = np.array(durations, dtype=np.float64) / 1e3
+                p50, p99 = np.percentile(values, [50, 99])
+                total = float(values.sum()) / 1e6
+            else:
+                p50 = p99 = total = 0.0
+            summary[phase] = {"calls": len(durations), "total": total,
+                              "p50": float(p50), "p99": float(p99)}
+        return summary
+
+    def reset(self):
+        # clear in place, the wrappers hold on to the lists
+        for durations in self.durations.values():
+            durations.clear()
+        self.last_report = time.perf_counter()
+
+    def report(self, reset=True):
+        """
+        Writes the summary in the configured output, then starts a new
+        period if `reset` is set.
+        Returns:
+            dict: The summary.
+        """
+        summary = self.summary()
+        stream = self.stream or sys.stdout
+        if self.output == "json":
+            print(json.dumps(summary), file=stream)
+        else:
+            print(f"{'phase':<10}{'calls':>10}{'total s':>10}{'p50 us':>10}"
+                  f"{'p99 us':>10}", file=stream)
+            for phase, stats in summary.items():
+                print(f"{phase:<10}{stats['calls']:>10}{stats['total']:>10.3f}"
+                      f"{stats['p50']:>10.1f}{stats['p99']:>10.1f}",
+                      file=stream)
+        if reset:
+            self.reset()
+        return summary
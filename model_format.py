@@ -0,0 +1,217 @@
+import argparse
+import mmap
+import os
+import pickle
+import struct
+
+import numpy as np
+
+from q_tables import (ACTIONS, VOCABULARIES, DenseQTable, StateVocabulary,
+                      greedy_policy)
+
+# -----------------------------------------------------------------------
+# Versioned binary Q-table format, loaded through mmap with no parse step.
+#
+#   header    magic, version, directions, actions, flags, number of
+#             states, size of the names block, offsets of the two arrays
+#   names     encoder ID then its tokens, UTF-8, each followed by a NUL
+#   visited   one byte per state, 1 if the state was ever updated
+#   values    float32 (states, actions), aligned to 64 bytes
+#
+# FLAG_SYMMETRIC marks tables learned on canonical states under the board
+# symmetries (SnakeEnvironment(symmetric=True)), whose actions are in the
+# canonical frame. The flags were padding before, so older files have none.
+#
+# All fields are little-endian. The file is mapped copy-on-write, so every
+# process loading the same model shares its pages until it writes to them.
+#
+# Greedy policies exported from a Q-table (PolicyAgent) use the same layout
+# with magic L2SP, no visited block and one uint8 action per state.
+#
+# Pickled models are a {"encoder": name, "symmetric": bool, "q_values":
+# {state: {action: value}}} dict with token tuple states. Older pickles
+# have no "symmetric" key, or are the bare q_values dict and load with no
+# encoder; neither is symmetric.
+# -----------------------------------------------------------------------
+
+MAGIC = b"L2SQ"
+POLICY_MAGIC = b"L2SP"
+VERSION = 1
+MODEL_EXTENSION = ".l2sq"
+POLICY_EXTENSION = ".l2sp"
+HEADER = struct.Struct("<4sHHHHIIQQ")
+ALIGNMENT = 64
+FLAG_SYMMETRIC = 1
+
+
+def is_model_file(filename, magic=MAGIC):
+    with open(filename, 'rb') as f:
+        return f.read(len(magic)) == magic
+
+
+def is_symmetric(filename):
+    """
+    Whether a binary model or policy file holds canonical-frame states.
+    """
+    with open(filename, 'rb') as f:
+        flags = HEADER.unpack(f.read(HEADER.size))[4]
+    return bool(flags & FLAG_SYMMETRIC)
+
+
+def _write(filename, magic, vocabulary, visited, values, symmetric=False):
+    names = b"".join(name.encode() + b"\0" for name
+                     in (vocabulary.name, *vocabulary.tokens))
+    visited_offset = HEADER.size + len(names)
+    visited = b"" if visited is None else visited.astype(np.uint8).tobytes()
+    values_offset = -(-(visited_offset + len(visited)) // ALIGNMENT) * \
+        ALIGNMENT
+    header = HEADER.pack(magic, VERSION, vocabulary.directions, len(ACTIONS),
+                         FLAG_SYMMETRIC if symmetric else 0, vocabulary.size,
+                         len(names), visited_offset, values_offset)
+    with open(filename, 'wb') as f:
+        f.write(header)
+        f.write(names)
+        f.write(visited)
+        f.write(b"\0" * (values_offset - visited_offset - len(visited)))
+        f.write(values.tobytes())
+
+
+def _map(filename, expected_magic):
+    """
+    Maps a file copy-on-write and checks its header.
+    Returns:
+        The mapping, its vocabulary, and the visited and values offsets.
+    """
+    with open(filename, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if len(data) < HEADER.size:
+        raise ValueError(f"{filename} is too short to be a model file")
+    magic, version, directions, actions, _, size, names_size, \
+        visited_offset, values_offset = HEADER.unpack_from(data)
+    if magic != expected_magic:
+        raise ValueError(f"{filename} is not a {expected_magic.decode()} "
+                         f"model file")
+    if version != VERSION:
+        raise ValueError(f"{filename} has model format version {version}, "
+                         f"expected {VERSION}")
+    if actions != len(ACTIONS):
+        raise ValueError(f"{filename} has {actions} actions, expected "
+                         f"{len(ACTIONS)}")
+
+    encoder, *tokens = data[HEADER.size:HEADER.size + names_size] \
+        .decode().split("\0")[:-1]
+    vocabulary = VOCABULARIES.get(encoder)
+    if vocabulary is None or list(vocabulary.tokens) != tokens or \
+            vocabulary.directions != directions:
+        vocabulary = StateVocabulary(encoder, tuple(tokens), directions)
+    if vocabulary.size != size:
+        raise ValueError(f"{filename} has {size} states, its vocabulary "
+                         f"{vocabulary.size}")
+    return data, vocabulary, visited_offset, values_offset
+
+
+def save_q_table(q_table, filename, symmetric=False):
+    """
+    Writes a DenseQTable to `filename` in the binary model format, flagged
+    FLAG_SYMMETRIC if `symmetric`.
+    """
+    _write(filename, MAGIC, q_table.vocabulary, q_table.visited,
+           np.ascontiguousarray(q_table.values, dtype='<f4'), symmetric)
+
+
+def load_q_table(filename):
+    """
+    Maps a model file copy-on-write and returns a DenseQTable whose arrays
+    are views into the mapping.
+    """
+    data, vocabulary, visited_offset, values_offset = _map(filename, MAGIC)
+    size = vocabulary.size
+    values = np.frombuffer(data, dtype='<f4', count=size * len(ACTIONS),
+                           offset=values_offset).reshape(size, len(ACTIONS))
+    q_table = DenseQTable(vocabulary, values)
+    q_table.visited = np.frombuffer(data, dtype=np.bool_, count=size,
+                                    offset=visited_offset)
+    return q_table
+
+
+def save_policy(vocabulary, policy, filename, symmetric=False):
+    """
+    Writes a greedy policy, one uint8 action index per state ID.
+    """
+    _write(filename, POLICY_MAGIC, vocabulary, None,
+           np.ascontiguousarray(policy, dtype=np.uint8), symmetric)
+
+
+def load_policy(filename):
+    """
+    Maps a policy file copy-on-write.
+    Returns:
+        Its vocabulary and the uint8 policy array viewing the mapping.
+    """
+    data, vocabulary, _, values_offset = _map(filename, POLICY_MAGIC)
+    return vocabulary, np.frombuffer(data, dtype=np.uint8,
+                                     count=vocabulary.size,
+                                     offset=values_offset)
+
+
+def save_pickle(q_values, encoder, filename, symmetric=False):
+    """
+    Pickles a nested {state: {action: value}} table with the name of the
+    encoder that produced its states and whether they are canonical. Packed
+    integer states are written as their token tuples.
+    """
+    states = VOCABULARIES[encoder].states
+    q_values = {states[state] if isinstance(state, (int, np.integer))
+                else state: dict(action_values)
+                for state, action_values in q_values.items()}
+    with open(filename, 'wb') as f:
+        pickle.dump({"encoder": encoder, "symmetric": symmetric,
+                     "q_values": q_values}, f)
+
+
+def load_pickle(filename):
+    """
+    Returns:
+        The encoder name of a pickled model (None for older pickles), its
+        nested {state: {action: value}} table, and whether it is symmetric.
+    """
+    with open(filename, 'rb') as f:
+        model = pickle.load(f)
+    if set(model) in ({"encoder", "q_values"},
+                      {"encoder", "symmetric", "q_values"}):
+        return model["encoder"], model["q_values"], \
+            model.get("symmetric", False)
+    return None, model, False
+
+
+def convert_pickle(filename, output=None, policy=False):
+    """
+    Converts a pickled {state: {action: value}} model to the binary format,
+    or to its greedy policy if `policy` is set.
+    Returns:
+        str: The name of the written file.
+    """
+    encoder, q_values, symmetric = load_pickle(filename)
+    vocabulary = VOCABULARIES[encoder] if encoder is not None else None
+    extension = POLICY_EXTENSION if policy else MODEL_EXTENSION
+    if output is None:
+        output = os.path.splitext(filename)[0] + extension
+    if policy:
+        save_policy(*greedy_policy(q_values, vocabulary), output, symmetric)
+    else:
+        save_q_table(DenseQTable.from_dict(q_values, vocabulary), output,
+                     symmetric)
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert pickled Q-table models to the binary format.")
+    parser.add_argument("models", nargs="+", help=".pkl models to convert")
+    parser.add_argument("--policy", action="store_true",
+                        help="export the greedy policy instead of the "
+                             "Q-values")
+    arguments = parser.parse_args()
+    for filename in arguments.models:
+        output = convert_pickle(filename, policy=arguments.policy)
+        print(f"{filename} -> {output} ({os.path.getsize(output)} bytes)")
@@ -0,0 +1,257 @@
+import os
+import random
+import time
+from collections import deque
+from multiprocessing import get_context
+from queue import Empty
+
+import numpy as np
+
+from agents import QLearningAgent
+from environments import SnakeEnvironment
+from game import SnakeGame
+from q_tables import ACTION_INDEX, DenseQTable, SharedQTable, VOCABULARIES
+from replay_buffers import ReplayBuffer
+from train_agent import quiet_stdout, train_agent
+
+# -----------------------------------------------------------------------
+# Actor/learner training: actor processes play episodes with a recent copy
+# of the policy and stream their transitions to the learner, which owns the
+# replay buffer and the Q-table and periodically publishes refreshed
+# Q-values to the actors.
+#
+# Hogwild training: worker processes each run train_agent's episode loop
+# with their own replay buffer, all reading and updating one SharedQTable
+# in place without locks.
+# -----------------------------------------------------------------------
+
+
+def _run_actor(actor_id, vocabulary_name, grid_size, max_steps, seed,
+               shared_values, policy_version, shared_epsilon, transitions,
+               stop):
+    """
+    Actor process: plays episodes with epsilon-greedy on its local copy of
+    the Q-values and puts one (actor_id, arrays..., snake_length, steps)
+    message per episode on `transitions`.
+    """
+    random.seed(seed)
+    vocabulary = VOCABULARIES[vocabulary_name]
+    agent = QLearningAgent(q_table=DenseQTable(vocabulary))
+    published = np.frombuffer(shared_values.get_obj(), dtype=np.float32) \
+        .reshape(agent.q_table.values.shape)
+    # observe the packed states of the learner's encoder, already state IDs
+    environment = SnakeEnvironment(SnakeGame(grid_size=grid_size), max_steps,
+                                   encoder=vocabulary_name, packed=True)
+    state_ids = vocabulary.ids
+    seen_version = -1
+
+    # traces of the hot paths stay off the shared terminal
+    with quiet_stdout():
+        while not stop.is_set():
+            if policy_version.value != seen_version:
+                with shared_values.get_lock():
+                    seen_version = policy_version.value
+                    np.copyto(agent.q_table.values, published)
+                    agent.epsilon = shared_epsilon.value
+
+            episode = []
+            state, _, possible_actions, done, snake_length = \
+                environment.reset()
+            while not done:
+                action = agent.act(state, possible_actions)
+                next_state, reward, possible_actions, done, snake_length = \
+                    environment.step(action)
+                episode.append((state_ids[state], ACTION_INDEX[action], reward,
+                                state_ids[next_state], done))
+                state = next_state
+
+            columns = [np.array(column) for column in zip(*episode)]
+            transitions.put((actor_id, *columns, snake_length, len(episode)))
+
+
+def _next_episode(transitions, processes):
+    # wait for the next episode, failing instead of hanging if an actor died
+    while True:
+        try:
+            return transitions.get(timeout=1)
+        except Empty:
+            dead = [process for process in processes
+                    if not process.is_alive()]
+            if dead:
+                raise RuntimeError(
+                    f"{len(dead)} actor process(es) died, exit code "
+                    f"{dead[0].exitcode}")
+
+
+def train_actor_learner(agent, episodes, actors=4, grid_size=10,
+                        max_steps=500, sync_interval=20, target_length=None,
+                        window=100, seed=0):
+    """
+    Train `agent` as the learner of `actors` actor processes.
+
+    The learner stores every episode an actor sends in its replay buffer and
+    trains once per episode, like `train_agent`. Every `sync_interval`
+    episodes it publishes its Q-values and epsilon to the actors through
+    shared memory.
+
+    Args:
+        agent: QLearningAgent with a DenseQTable and a ReplayBuffer sharing
+            its vocabulary.
+        episodes (int): Number of episodes to learn from.
+        actors (int): Number of actor processes.
+        grid_size (int): Grid size of the actors' SnakeGame.
+        max_steps (int): Max steps per episode of the actors' SnakeEnvironment.
+        sync_interval (int): Episodes between two policy publications.
+        target_length (float): Stop early once the average snake length over
+            the last `window` episodes reaches it.
+        window (int): Number of episodes of the moving average.
+        seed (int): Actor i seeds its `random` with seed + i.
+    Returns:
+        dict: episodes, elapsed seconds, time_to_target (None if not
+            reached), average_length of the last window, and
+            episodes_per_second for every actor.
+    """
+    if not isinstance(agent.q_table, DenseQTable) or \
+            not isinstance(agent.buffer, ReplayBuffer) or \
+            agent.buffer.vocabulary is not agent.q_table.vocabulary:
+        raise ValueError("The learner needs a DenseQTable and a ReplayBuffer "
+                         "sharing its vocabulary")
+    # the actors observe states of the table's encoder
+    if agent.encoder is None:
+        agent.encoder = agent.q_table.vocabulary.name
+    context = get_context()
+    values = agent.q_table.values
+    shared_values = context.Array('f', values.size)
+    published = np.frombuffer(shared_values.get_obj(), dtype=np.float32) \
+        .reshape(values.shape)
+    policy_version = context.Value('i', 0, lock=False)
+    shared_epsilon = context.Value('d', agent.epsilon, lock=False)
+    transitions = context.Queue()
+    stop = context.Event()
+
+    def publish():
+        with shared_values.get_lock():
+            np.copyto(published, values)
+            shared_epsilon.value = max(agent.minimum_epsilon, agent.epsilon)
+            policy_version.value += 1
+
+    publish()
+    processes = [
+        context.Process(target=_run_actor, daemon=True, args=(
+            actor_id, agent.q_table.vocabulary.name, grid_size, max_steps,
+            seed + actor_id, shared_values, policy_version, shared_epsilon,
+            transitions, stop))
+        for actor_id in range(actors)
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+
+    actor_episodes = [0] * actors
+    lengths = deque(maxlen=window)
+    time_to_target = None
+    learned = 0
+    try:
+        while learned < episodes:
+            actor_id, state_ids, action_indexes, rewards, next_state_ids, \
+                dones, snake_length, steps = _next_episode(transitions,
+                                                           processes)
+            agent.buffer.extend(state_ids, action_indexes, rewards,
+                                next_state_ids, dones)
+            agent.train()
+            learned += 1
+            actor_episodes[actor_id] += 1
+            lengths.append(snake_length)
+
+            if learned % sync_interval == 0:
+                publish()
+                print(f"Episode {learned}/{episodes}, Average Snake Length: "
+                      f"{sum(lengths) / len(lengths):.2f}")
+            if target_length is not None and len(lengths) == window and \
+                    sum(lengths) / window >= target_length:
+                time_to_target = time.perf_counter() - start
+                break
+    finally:
+        stop.set()
+        # drain the queue so actors blocked on its pipe can exit
+        while any(process.is_alive() for process in processes):
+            try:
+                transitions.get(timeout=0.1)
+            except Empty:
+                pass
+        for process in processes:
+            process.join()
+
+    elapsed = time.perf_counter() - start
+    report = {
+        "episodes": learned,
+        "elapsed": elapsed,
+        "time_to_target": time_to_target,
+        "average_length": sum(lengths) / len(lengths) if lengths else 0,
+        "episodes_per_second": [count / elapsed for count in actor_episodes],
+    }
+    print(f"Learned from {learned} episodes in {elapsed:.1f}s")
+    for actor_id, rate in enumerate(report["episodes_per_second"]):
+        print(f"Actor {actor_id}: {rate:.1f} episodes/s")
+    return report
+
+
+def _run_hogwild_worker(q_table, episodes, grid_size, max_steps, seed,
+                        agent_kwargs):
+    random.seed(seed)
+    agent_kwargs = dict(agent_kwargs)
+    buffer = ReplayBuffer(agent_kwargs.pop("buffer_size", 1000),
+                          q_table.vocabulary, seed=seed)
+    agent = QLearningAgent(q_table=q_table, buffer=buffer, **agent_kwargs)
+    # observe packed states of the table's encoder, already state IDs
+    environment = SnakeEnvironment(SnakeGame(grid_size=grid_size), max_steps,
+                                   encoder=q_table.vocabulary.name,
+                                   packed=True)
+    # keep the progress prints off the shared terminal
+    with quiet_stdout():
+        train_agent(agent, environment, episodes)
+    q_table.close()
+
+
+def train_hogwild(q_table, episodes, workers=4, grid_size=10, max_steps=500,
+                  seed=0, **agent_kwargs):
+    """
+    Train a SharedQTable with `workers` processes updating it in place.
+
+    Args:
+        q_table (SharedQTable): The table every worker learns into.
+        episodes (int): Number of episodes per worker.
+        workers (int): Number of worker processes.
+        grid_size (int): Grid size of the workers' SnakeGame.
+        max_steps (int): Max steps per episode of the workers' SnakeEnvironment.
+        seed (int): Worker i seeds its `random` and buffer with seed + i.
+        **agent_kwargs: QLearningAgent arguments of every worker;
+            `buffer_size` sizes each worker's ReplayBuffer.
+    Returns:
+        float: Elapsed seconds.
+    """
+    context = get_context()
+    processes = [
+        context.Process(target=_run_hogwild_worker, args=(
+            q_table, episodes, grid_size, max_steps, seed + worker,
+            agent_kwargs))
+        for worker in range(workers)
+    ]
+    start = time.perf_counter()
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    print(f"{workers} workers trained {workers * episodes} episodes in "
+          f"{elapsed:.1f}s, {len(q_table)} states visited")
+    return elapsed
+
+
+if __name__ == "__main__":
+    vocabulary = VOCABULARIES["depth"]
+    agent = QLearningAgent(alpha=0.1, gamma=0.9, epsilon_decay=0.9998, epsilon=0.9, minimum_epsilon=0.02,
+                           batch_size=256, q_table=DenseQTable(vocabulary),
+                           buffer=ReplayBuffer(16000, vocabulary))
+    train_actor_learner(agent, episodes=20000, actors=os.cpu_count(), max_steps=500, target_length=15)
+    agent.save("actor_learner.l2sq")
@@ -0,0 +1,90 @@
+import numpy as np
+
+# -----------------------------------------------------------------------
+# Q-functions approximated by small NumPy networks, for agents observing
+# SnakeEnvironment features instead of table states. Memory depends on the
+# layer sizes only, never on the number of states.
+# -----------------------------------------------------------------------
+
+
+class QNetwork:
+    """
+    Fully connected network mapping a batch of feature rows to one Q-value
+    per action: a linear model without hidden layers, an MLP with ReLU
+    hidden layers otherwise. Trained with Adam.
+    """
+    def __init__(self, inputs, hidden=(64,), outputs=4, seed=None):
+        """
+        Args:
+            inputs (int): Number of features.
+            hidden (tuple): Width of every hidden layer; () for linear.
+            outputs (int): Number of actions.
+            seed (int): Seed of the weight initialization.
+        """
+        rng = np.random.default_rng(seed)
+        sizes = [inputs, *hidden, outputs]
+        self.hidden = tuple(hidden)
+        self.params = []
+        for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+            # He initialization for the ReLU layers
+            self.params.append(rng.normal(0, np.sqrt(2 / fan_in),
+                                          (fan_in, fan_out))
+                               .astype(np.float32))
+            self.params.append(np.zeros(fan_out, dtype=np.float32))
+        self.moments = [np.zeros_like(param) for param in self.params]
+        self.squares = [np.zeros_like(param) for param in self.params]
+        self.steps = 0
+
+    def forward(self, features, keep_activations=False):
+        """
+        Returns the (N, outputs) Q-values of (N, inputs) features, and the
+        input of every layer if `keep_activations` is set.
+        """
+        activations = [features]
+        x = features
+        last = len(self.params) // 2 - 1
+        for layer in range(last + 1):
+            x = x @ self.params[2 * layer] + self.params[2 * layer + 1]
+            if layer < last:
+                x = np.maximum(x, 0)
+                activations.append(x)
+        if keep_activations:
+            return x, activations
+        return x
+
+    def gradients(self, activations, output_gradient):
+        """
+        Backpropagates the gradient of the loss with respect to the outputs
+        through the layers whose inputs are `activations`.
+        """
+        gradients = [None] * len(self.params)
+        delta = output_gradient
+        for layer in range(len(self.params) // 2 - 1, -1, -1):
+            gradients[2 * layer] = activations[layer].T @ delta
+            gradients[2 * layer + 1] = delta.sum(axis=0)
+            if layer:
+                delta = (delta @ self.params[2 * layer].T) * \
+                    (activations[layer] > 0)
+        return gradients
+
+    def apply_gradients(self, gradients, learning_rate, beta1=0.9,
+                        beta2=0.999, epsilon=1e-8):
+        self.steps += 1
+        correction1 = 1 - beta1 ** self.steps
+        correction2 = 1 - beta2 ** self.steps
+        for param, gradient, moment, square in zip(
+                self.params, gradients, self.moments, self.squares):
+            moment *= beta1
+            moment += (1 - beta1) * gradient
+            square *= beta2
+            square += (1 - beta2) * gradient * gradient
+            param -= (learning_rate * (moment / correction1) /
+                      (np.sqrt(square / correction2) + epsilon)) \
+                .astype(np.float32)
+
+    def copy_from(self, network):
+        for param, source in zip(self.params, network.params):
+            np.copyto(param, source)
+
+    def nbytes(self):
+        return sum(param.nbytes for param in self.params)
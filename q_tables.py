@@ -0,0 +1,478 @@
+import sys
+from array import array
+from collections import defaultdict
+from itertools import product
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from constants import Directions
+from encoders import ENCODERS
+
+# -----------------------------------------------------------------------
+# Q-table backends for QLearningAgent. Each one answers `q_value`,
+# `best_action`, `max_q_value`, `known_actions` and `add`, and converts
+# to and from the nested {state: {action: value}} dict that gets pickled.
+# -----------------------------------------------------------------------
+
+ACTIONS = list(Directions)
+ACTION_INDEX = {action: index for index, action in enumerate(ACTIONS)}
+
+
+class StateVocabulary:
+    """
+    Every observation one vision encoder can produce, numbered densely.
+
+    An observation is a tuple of one token per direction, or "terminal".
+    Tuples are numbered in the order of `itertools.product` over the token
+    indexes, so a row of per-direction token codes maps to its ID with a
+    dot product, and "terminal" takes the last ID. The packed integer
+    states of the matching encoder are their own ID, and `ids` maps them
+    too.
+    """
+    def __init__(self, name, tokens, directions=4):
+        self.name = name
+        self.tokens = tokens
+        self.directions = directions
+        self.size = len(tokens) ** directions + 1
+        self.terminal_id = self.size - 1
+        self.states = [tuple(state) for state
+                       in product(tokens, repeat=directions)]
+        self.states.append("terminal")
+        self.ids = {state: state_id for state_id, state
+                    in enumerate(self.states)}
+        self.ids.update((state_id, state_id) for state_id in range(self.size))
+        self.powers = len(tokens) ** np.arange(directions - 1, -1, -1)
+
+    def state_id(self, state):
+        return self.ids[state]
+
+    def state_ids(self, codes):
+        """
+        Returns the state IDs of an (N, directions) array of token codes.
+        """
+        return np.asarray(codes) @ self.powers
+
+    def __contains__(self, state):
+        return state in self.ids
+
+
+# one vocabulary per observation encoder, sharing its name
+VOCABULARIES = {
+    name: StateVocabulary(name, encoder.tokens, encoder.directions)
+    for name, encoder in ENCODERS.items()
+}
+
+
+def infer_vocabulary(states):
+    """
+    Returns the smallest vocabulary that contains every state in `states`.
+    """
+    states = list(states)
+    if any(isinstance(state, (int, np.integer)) for state in states):
+        raise ValueError("Packed states do not tell which encoder made them")
+    for vocabulary in sorted(VOCABULARIES.values(), key=lambda v: v.size):
+        if all(state in vocabulary for state in states):
+            return vocabulary
+    raise ValueError("No vocabulary matches the states of this Q-table")
+
+
+def as_direction(action):
+    # older models key actions by their direction tuple
+    if isinstance(action, Directions):
+        return action
+    return Directions.from_tuple(action)
+
+
+def greedy_policy(q_table, vocabulary=None):
+    """
+    Freezes a Q-table into its greedy policy. Ties go to the first action in
+    Directions order, like `best_action`, and unseen states get action 0.
+    Args:
+        q_table: A DenseQTable, DictQTable or nested {state: {action: value}}
+            dict.
+        vocabulary: StateVocabulary of a dict's states, inferred from them
+            if None.
+    Returns:
+        The StateVocabulary and a uint8 array of the best action index per
+        state ID.
+    """
+    if isinstance(q_table, DenseQTable):
+        return q_table.vocabulary, \
+            q_table.values.argmax(axis=1).astype(np.uint8)
+    if vocabulary is None:
+        vocabulary = infer_vocabulary(q_table)
+    policy = np.zeros(vocabulary.size, dtype=np.uint8)
+    for state, action_values in q_table.items():
+        # read in full precision, a float32 copy could flip near ties
+        values = [0.0] * len(ACTIONS)
+        for action, value in action_values.items():
+            values[ACTION_INDEX[as_direction(action)]] = value
+        policy[vocabulary.ids[state]] = values.index(max(values))
+    return vocabulary, policy
+
+
+def _action_values():
+    return defaultdict(float)
+
+
+class DictQTable(defaultdict):
+    """
+    The original nested defaultdict Q-table. Reads insert missing states and
+    actions with a value of 0.0, and `known_actions` are the actions that
+    were read or written for that state.
+    """
+    def __init__(self, q_values=None):
+        super().__init__(_action_values)
+        if q_values:
+            self.load_dict(q_values)
+
+    def __reduce__(self):
+        return type(self), (self.to_dict(),)
+
+    def q_value(self, state, action):
+        return self[state][action]
+
+    def best_action(self, state, actions):
+        return max(actions, key=self[state].__getitem__)
+
+    def max_q_value(self, state, actions):
+        if not actions:
+            return 0
+        action_values = self[state]
+        return max([action_values[action] for action in actions])
+
+    def known_actions(self, state):
+        return list(self[state].keys())
+
+    def add(self, state, action, delta):
+        self[state][action] += delta
+
+    def to_dict(self):
+        return dict(self)
+
+    def load_dict(self, q_values):
+        self.clear()
+        for state, action_values in q_values.items():
+            self[state] = defaultdict(float, action_values)
+
+
+class DenseQTable:
+    """
+    Q-values in a float32 array of shape (vocabulary.size, 4), one row per
+    state ID and one column per action in Directions order.
+
+    Unseen states read as 0.0 for every action without allocating anything.
+    `visited` marks the rows that were written or loaded; only those are
+    exported by `to_dict`, so a round trip through pickle keeps the table
+    the same size.
+    """
+    def __init__(self, vocabulary, values=None):
+        self.vocabulary = vocabulary
+        if values is None:
+            values = np.zeros((vocabulary.size, len(ACTIONS)),
+                              dtype=np.float32)
+        self.values = values
+        self.visited = np.zeros(vocabulary.size, dtype=bool)
+
+    @classmethod
+    def from_dict(cls, q_values, vocabulary=None):
+        """
+        Converts a nested {state: {action: value}} table, such as the one
+        pickled in DEPTH300k.pkl, picking its vocabulary if none is given.
+        """
+        if vocabulary is None:
+            vocabulary = infer_vocabulary(q_values)
+        q_table = cls(vocabulary)
+        q_table.load_dict(q_values)
+        return q_table
+
+    def __len__(self):
+        return int(self.visited.sum())
+
+    def q_value(self, state, action):
+        state_id = self.vocabulary.ids[state]
+        return float(self.values[state_id, ACTION_INDEX[action]])
+
+    def best_action(self, state, actions):
+        action_values = self.values[self.vocabulary.ids[state]]
+        if len(actions) == len(ACTIONS):
+            return ACTIONS[int(action_values.argmax())]
+        return max(actions,
+                   key=lambda action: action_values[ACTION_INDEX[action]])
+
+    def max_q_value(self, state, actions):
+        if not actions:
+            return 0
+        action_values = self.values[self.vocabulary.ids[state]]
+        if len(actions) == len(ACTIONS):
+            return float(action_values.max())
+        return float(max(action_values[ACTION_INDEX[action]]
+                         for action in actions))
+
+    def known_actions(self, state):
+        # every action has a value in a dense row
+        return ACTIONS
+
+    def add(self, state, action, delta):
+        state_id = self.vocabulary.ids[state]
+        self.values[state_id, ACTION_INDEX[action]] += delta
+        self.visited[state_id] = True
+
+    def to_dict(self):
+        q_values = {}
+        for state_id in np.flatnonzero(self.visited):
+            q_values[self.vocabulary.states[state_id]] = defaultdict(
+                float, zip(ACTIONS, self.values[state_id].tolist()))
+        return q_values
+
+    def load_dict(self, q_values):
+        self.values[:] = 0
+        self.visited[:] = False
+        for state, action_values in q_values.items():
+            state_id = self.vocabulary.ids[state]
+            for action, value in action_values.items():
+                self.values[state_id, ACTION_INDEX[as_direction(action)]] = value
+            self.visited[state_id] = True
+
+
+class BoundedQTable:
+    """
+    Q-values of at most `max_entries` states, in preallocated float32 rows
+    found through a {state: slot} dict. Reads of unknown states return 0.0
+    without allocating; only `add` creates rows.
+
+    When full, the `evict_fraction` of the rows that are least recently used
+    ("lru") or least visited ("visits", ties going to the least recent) are
+    dropped at once, so eviction costs O(1) amortized per insertion. Every
+    read or write of a known state counts as a visit.
+    """
+    EVICTION_POLICIES = ("lru", "visits")
+    # dict entry, slot int and key tuple of a state, on top of its arrays
+    STATE_OVERHEAD = 120
+
+    def __init__(self, max_entries=None, max_bytes=None, eviction="lru",
+                 evict_fraction=1 / 16):
+        """
+        Args:
+            max_entries (int): Maximum number of states kept.
+            max_bytes (int): Memory budget, converted to a number of entries
+                if `max_entries` is None. One of the two is required.
+            eviction (str): "lru" or "visits".
+            evict_fraction (float): Share of the rows dropped by an eviction.
+        """
+        if eviction not in self.EVICTION_POLICIES:
+            raise ValueError(f"Unknown eviction policy {eviction!r}, expected "
+                             f"one of {', '.join(self.EVICTION_POLICIES)}")
+        if max_entries is None:
+            if max_bytes is None:
+                raise ValueError("BoundedQTable needs max_entries or "
+                                 "max_bytes")
+            max_entries = max_bytes // self.entry_size()
+        if max_entries < 1:
+            raise ValueError("BoundedQTable needs room for at least one state")
+        self.max_entries = max_entries
+        self.eviction = eviction
+        self.evict_count = max(1, int(max_entries * evict_fraction))
+        self.values = np.zeros((max_entries, len(ACTIONS)), dtype=np.float32)
+        # counters in arrays of Python ints, cheaper to bump one at a time
+        # than NumPy scalars, and viewed as NumPy arrays to evict
+        self.visits = array('q', bytes(8 * max_entries))
+        self.last_used = array('q', bytes(8 * max_entries))
+        self.slots = {}
+        self.states = [None] * max_entries
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.clock = 0
+        self.reads = 0
+        self.hits = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @classmethod
+    def entry_size(cls):
+        return len(ACTIONS) * np.dtype(np.float32).itemsize + \
+            2 * np.dtype(np.int64).itemsize + cls.STATE_OVERHEAD
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, state):
+        return state in self.slots
+
+    def _read(self, state):
+        # the row of a known state, None otherwise; counts the access
+        self.reads += 1
+        slot = self.slots.get(state)
+        if slot is None:
+            return None
+        self.hits += 1
+        self.clock += 1
+        self.visits[slot] += 1
+        self.last_used[slot] = self.clock
+        return self.values[slot]
+
+    def q_value(self, state, action):
+        action_values = self._read(state)
+        if action_values is None:
+            return 0.0
+        return float(action_values[ACTION_INDEX[action]])
+
+    def best_action(self, state, actions):
+        action_values = self._read(state)
+        if action_values is None:
+            return actions[0]
+        if len(actions) == len(ACTIONS):
+            return ACTIONS[int(action_values.argmax())]
+        return max(actions,
+                   key=lambda action: action_values[ACTION_INDEX[action]])
+
+    def max_q_value(self, state, actions):
+        if not actions:
+            return 0
+        action_values = self._read(state)
+        if action_values is None:
+            return 0.0
+        if len(actions) == len(ACTIONS):
+            return float(action_values.max())
+        return float(max(action_values[ACTION_INDEX[action]]
+                         for action in actions))
+
+    def known_actions(self, state):
+        return ACTIONS if state in self.slots else []
+
+    def add(self, state, action, delta):
+        self.writes += 1
+        slot = self.slots.get(state)
+        if slot is None:
+            slot = self._allocate(state)
+        self.clock += 1
+        self.visits[slot] += 1
+        self.last_used[slot] = self.clock
+        self.values[slot, ACTION_INDEX[action]] += delta
+
+    def _allocate(self, state):
+        if not self.free_slots:
+            self._evict()
+        slot = self.free_slots.pop()
+        self.slots[state] = slot
+        self.states[slot] = state
+        self.values[slot] = 0
+        self.visits[slot] = 0
+        return slot
+
+    def _evict(self):
+        last_used = np.frombuffer(self.last_used, dtype=np.int64)
+        if self.eviction == "lru":
+            keys = last_used
+        else:
+            # least visited first, then least recently used
+            keys = np.frombuffer(self.visits, dtype=np.int64) * \
+                (self.clock + 1) + last_used
+        count = min(self.evict_count, len(self.slots))
+        for slot in np.argpartition(keys, count - 1)[:count].tolist():
+            del self.slots[self.states[slot]]
+            self.states[slot] = None
+            self.free_slots.append(slot)
+        self.evictions += count
+
+    def memory_usage(self):
+        """
+        Returns:
+            int: Approximate bytes held, arrays and state index included.
+        """
+        return self.values.nbytes + sys.getsizeof(self.visits) + \
+            sys.getsizeof(self.last_used) + sys.getsizeof(self.slots) + \
+            sys.getsizeof(self.states) + sys.getsizeof(self.free_slots)
+
+    def stats(self):
+        """
+        Returns:
+            dict: entries, max_entries, memory_bytes, reads, hits, hit_rate,
+                writes and evictions since creation or `reset_stats`.
+        """
+        return {
+            "entries": len(self.slots),
+            "max_entries": self.max_entries,
+            "memory_bytes": self.memory_usage(),
+            "reads": self.reads,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.reads if self.reads else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+    def reset_stats(self):
+        self.reads = self.hits = self.writes = self.evictions = 0
+
+    def to_dict(self):
+        return {state: defaultdict(float, zip(ACTIONS,
+                                              self.values[slot].tolist()))
+                for state, slot in self.slots.items()}
+
+    def load_dict(self, q_values):
+        self.slots.clear()
+        self.states = [None] * self.max_entries
+        self.free_slots = list(range(self.max_entries - 1, -1, -1))
+        self.visits = array('q', bytes(8 * self.max_entries))
+        self.last_used = array('q', bytes(8 * self.max_entries))
+        for state, action_values in q_values.items():
+            slot = self.slots.get(state)
+            if slot is None:
+                slot = self._allocate(state)
+            for action, value in action_values.items():
+                self.values[slot, ACTION_INDEX[as_direction(action)]] = value
+
+
+class SharedQTable(DenseQTable):
+    """
+    DenseQTable whose values and visited flags live in one
+    multiprocessing.shared_memory block, so several processes read and
+    update the same Q-values in place, without locks (Hogwild-style).
+
+    Processes agree on state IDs by sharing the vocabulary name, and attach
+    to the block by its name; pickling a SharedQTable sends just those two.
+    The creating process calls `unlink` once every process is done. Being a
+    DenseQTable, it saves with QLearningAgent.save like any other table.
+    """
+    def __init__(self, vocabulary, name=None):
+        shape = (vocabulary.size, len(ACTIONS))
+        values_size = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        create = name is None
+        self.shared_memory = SharedMemory(name=name, create=create,
+                                          size=values_size + vocabulary.size)
+        values = np.ndarray(shape, dtype=np.float32,
+                            buffer=self.shared_memory.buf)
+        super().__init__(vocabulary, values)
+        self.visited = np.ndarray(vocabulary.size, dtype=bool,
+                                  buffer=self.shared_memory.buf,
+                                  offset=values_size)
+        if create:
+            self.values[:] = 0
+            self.visited[:] = False
+
+    @classmethod
+    def attach(cls, vocabulary_name, name):
+        return cls(VOCABULARIES[vocabulary_name], name)
+
+    def __reduce__(self):
+        return SharedQTable.attach, (self.vocabulary.name, self.name)
+
+    @property
+    def name(self):
+        return self.shared_memory.name
+
+    def snapshot(self):
+        """
+        Returns a private DenseQTable copy of the current Q-values.
+        """
+        q_table = DenseQTable(self.vocabulary, self.values.copy())
+        q_table.visited = self.visited.copy()
+        return q_table
+
+    def close(self):
+        # the arrays must not be used after closing
+        del self.values, self.visited
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.shared_memory.unlink()
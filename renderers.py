@@ -0,0 +1,196 @@
+import sys
+from abc import ABC, abstractmethod
+from time import sleep
+
+from constants import Directions
+
+# -----------------------------------------------------------------------
+# Renderers draw a SnakeGame after every step. SnakeGame itself only
+# simulates; pygame is imported when a PygameRenderer is created, so
+# headless training and benchmark processes never load it.
+# -----------------------------------------------------------------------
+
+
+class Renderer(ABC):
+    # renderers that can read the keyboard for SnakeGame.human_play
+    interactive = False
+
+    def open(self, game):
+        pass
+
+    @abstractmethod
+    def draw(self, game):
+        pass
+
+    def draw_game_over(self, game):
+        pass
+
+    def close(self):
+        pass
+
+
+class NullRenderer(Renderer):
+    """
+    Draws nothing. The renderer of headless games.
+    """
+    def draw(self, game):
+        pass
+
+
+class TextRenderer(Renderer):
+    """
+    Prints the grid as text after every step: H is the head, S the body,
+    G a green apple and R the red apple.
+    """
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def draw(self, game):
+        grid = [['.'] * game.grid_size for _ in range(game.grid_size)]
+        for apple in game.green_apples:
+            grid[apple.position[1]][apple.position[0]] = 'G'
+        grid[game.red_apple.position[1]][game.red_apple.position[0]] = 'R'
+        for index, (x, y) in enumerate(game.snake):
+            if 0 <= x < game.grid_size and 0 <= y < game.grid_size:
+                grid[y][x] = 'H' if index == 0 else 'S'
+        border = '+' + '-' * game.grid_size + '+'
+        lines = [border] + ['|' + ''.join(row) + '|' for row in grid] + \
+            [border]
+        print('\n'.join(lines), file=self.stream or sys.stdout)
+
+    def draw_game_over(self, game):
+        print("GAME OVER", file=self.stream or sys.stdout)
+
+
+class PygameRenderer(Renderer):
+    colors = {
+        'background': (0, 0, 0),
+        'snake_body': (200, 200, 200),
+        'snake_head': (255, 255, 255),
+        'green_apple': (0, 255, 0),
+        'red_apple': (255, 0, 0)
+    }
+    interactive = True
+
+    def __init__(self, block_size=50, margin=50):
+        import pygame
+        self.pg = pygame
+        self.block_size = block_size
+        self.margin = margin
+        self.screen = None
+
+    def open(self, game):
+        pg = self.pg
+        # Make the window larger than the grid
+        self.screen_size = (game.grid_size * self.block_size) + \
+            2 * self.margin
+        pg.init()
+        self.screen = pg.display.set_mode((self.screen_size,
+                                           self.screen_size))
+        pg.display.set_caption("Snake")
+        self.clock = pg.time.Clock()
+        self.font = pg.font.Font(None, 69)
+
+    def close(self):
+        self.pg.quit()
+
+    def tick(self, fps):
+        self.clock.tick(fps)
+
+    def handle_events(self, game):
+        pg = self.pg
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                self._quit_game()
+            elif event.type == pg.KEYDOWN:
+                self._handle_keydown(game, event)
+
+    def _handle_keydown(self, game, event):
+        pg = self.pg
+        if event.key == pg.K_ESCAPE:
+            self._quit_game()
+        elif event.key == pg.K_w:
+            game.snake.add_direction_to_buffer(Directions.UP)
+        elif event.key == pg.K_s:
+            game.snake.add_direction_to_buffer(Directions.DOWN)
+        elif event.key == pg.K_a:
+            game.snake.add_direction_to_buffer(Directions.LEFT)
+        elif event.key == pg.K_d:
+            game.snake.add_direction_to_buffer(Directions.RIGHT)
+        elif event.key == pg.K_SPACE and game.game_over:
+            self._restart_game(game)
+
+    def _quit_game(self):
+        self.pg.quit()
+        sys.exit()
+
+    def _restart_game(self, game):
+        game.reset()
+        self.pg.event.clear()
+        self.draw(game)
+        sleep(1)
+        self.clock.tick(5)
+
+    def draw(self, game):
+        pg = self.pg
+        # Clear screen
+        self.screen.fill(self.colors['background'])
+
+        # Adjust drawing offset to center the grid within the window
+        grid_offset = self.margin
+
+        for segment in reversed(game.snake.body):
+            # Head is white, body is light gray
+            color = self.colors['snake_head'] if segment == game.snake.body[0]\
+                else self.colors['snake_body']
+            pg.draw.rect(self.screen, color,
+                         (grid_offset + segment[0] * self.block_size,
+                          grid_offset + segment[1] * self.block_size,
+                          self.block_size,
+                          self.block_size))
+
+        # Draw green apples (from current state)
+        for apple in game.green_apples:
+            pg.draw.rect(self.screen, self.colors['green_apple'],
+                         (grid_offset + apple.position[0] * self.block_size,
+                          grid_offset + apple.position[1] * self.block_size,
+                          self.block_size, self.block_size))
+
+        # Draw red apple (from current state)
+        pg.draw.rect(self.screen, self.colors['red_apple'],
+                     (grid_offset + game.red_apple.position[0] *
+                      self.block_size, grid_offset +
+                      game.red_apple.position[1] * self.block_size,
+                      self.block_size, self.block_size))
+
+        # Draw the grid (black lines)
+        for x in range(game.grid_size + 1):
+            pg.draw.line(self.screen, self.colors['background'],
+                         (grid_offset + x * self.block_size, grid_offset),
+                         (grid_offset + x * self.block_size,
+                          self.screen_size - self.margin))
+        for y in range(game.grid_size + 1):
+            pg.draw.line(self.screen, self.colors['background'],
+                         (grid_offset, grid_offset + y * self.block_size),
+                         (self.screen_size - self.margin, grid_offset + y *
+                          self.block_size))
+
+        # Draw bounding box (grey lines)
+        pg.draw.rect(self.screen, (150, 150, 150),
+                     (grid_offset, grid_offset,
+                      game.grid_size * self.block_size,
+                      game.grid_size * self.block_size), 1)
+
+        if not game.game_over:
+            pg.display.flip()
+
+        # this is needed to not have the OS freeze the window when rendering is True
+        pg.event.pump()
+
+    def draw_game_over(self, game):
+        # Display "Game Over" message in the center
+        text = self.font.render("GAME OVER", True, (255, 200, 0))
+        text_rect = text.get_rect(center=(self.screen_size // 2,
+                                          self.screen_size // 2))
+        self.screen.blit(text, text_rect)
+        self.pg.display.flip()
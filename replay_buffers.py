@@ -0,0 +1,276 @@
+from collections import namedtuple
+
+import numpy as np
+
+from q_tables import ACTIONS, ACTION_INDEX
+
+# -----------------------------------------------------------------------
+# Array-backed replay buffers for QLearningAgent. They keep the
+# `append(experience)` / `len()` interface of the deque they replace, and
+# add `sample(batch_size)`, `transitions(batch)` and `update_priorities`.
+# -----------------------------------------------------------------------
+
+ReplayBatch = namedtuple("ReplayBatch", ["indices", "states", "actions",
+                                         "rewards", "next_states", "dones",
+                                         "weights"])
+
+
+class InternedStates:
+    """
+    Hands out increasing integer IDs to states the first time they are
+    seen. Used when no fixed StateVocabulary is given; it has the same
+    `ids`, `states` and `state_id` as one.
+    """
+    def __init__(self):
+        self.ids = {}
+        self.states = []
+
+    def state_id(self, state):
+        state_id = self.ids.get(state)
+        if state_id is None:
+            state_id = self.ids[state] = len(self.states)
+            self.states.append(state)
+        return state_id
+
+
+class ReplayBuffer:
+    """
+    Ring buffer of preallocated NumPy arrays holding state ID, action index,
+    reward, next state ID and done for every experience, with O(batch)
+    uniform sampling.
+    """
+    def __init__(self, capacity, vocabulary=None, seed=None):
+        """
+        Args:
+            capacity (int): Maximum number of experiences kept.
+            vocabulary: StateVocabulary mapping states to IDs. States are
+                interned as they come if None.
+            seed (int): Seed of the sampling generator.
+        """
+        self.capacity = capacity
+        self.vocabulary = vocabulary if vocabulary is not None \
+            else InternedStates()
+        self.rng = np.random.default_rng(seed)
+        self.states = np.zeros(capacity, dtype=np.int64)
+        self.actions = np.zeros(capacity, dtype=np.int8)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros(capacity, dtype=np.int64)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.position = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, experience):
+        """
+        Stores a (state, action, reward, next_state, done) experience,
+        overwriting the oldest one once the buffer is full.
+        """
+        state, action, reward, next_state, done = experience
+        self.store(self.position, self.vocabulary.state_id(state),
+                   ACTION_INDEX[action], reward,
+                   self.vocabulary.state_id(next_state), done)
+
+    def store(self, index, state_id, action_index, reward, next_state_id,
+              done):
+        self.states[index] = state_id
+        self.actions[index] = action_index
+        self.rewards[index] = reward
+        self.next_states[index] = next_state_id
+        self.dones[index] = done
+        self.position = (index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def extend(self, state_ids, action_indexes, rewards, next_state_ids,
+               dones):
+        """
+        Stores a batch of already encoded experiences with array writes,
+        wrapping around the ring.
+        Returns:
+            np.ndarray: The buffer indices they were written to.
+        """
+        count = min(len(state_ids), self.capacity)
+        indices = (self.position + np.arange(count)) % self.capacity
+        self.states[indices] = state_ids[-count:]
+        self.actions[indices] = action_indexes[-count:]
+        self.rewards[indices] = rewards[-count:]
+        self.next_states[indices] = next_state_ids[-count:]
+        self.dones[indices] = dones[-count:]
+        self.position = (self.position + count) % self.capacity
+        self.size = min(self.size + count, self.capacity)
+        return indices
+
+    def sample(self, batch_size):
+        """
+        Samples `batch_size` experiences uniformly, with replacement.
+        Returns:
+            ReplayBatch: arrays of the sampled experiences, weights all 1.
+        """
+        indices = self.rng.integers(0, self.size, size=batch_size)
+        return self._batch(indices, np.ones(batch_size, dtype=np.float32))
+
+    def _batch(self, indices, weights):
+        return ReplayBatch(indices, self.states[indices],
+                           self.actions[indices], self.rewards[indices],
+                           self.next_states[indices], self.dones[indices],
+                           weights)
+
+    def transitions(self, batch):
+        """
+        Yields (state, action, reward, next_state, done, weight) for every
+        experience of `batch`, with states and actions decoded.
+        """
+        states = self.vocabulary.states
+        for state_id, action_index, reward, next_state_id, done, weight in \
+                zip(batch.states.tolist(), batch.actions.tolist(),
+                    batch.rewards.tolist(), batch.next_states.tolist(),
+                    batch.dones.tolist(), batch.weights.tolist()):
+            yield (states[state_id], ACTIONS[action_index], reward,
+                   states[next_state_id], done, weight)
+
+    def update_priorities(self, indices, td_errors):
+        # uniform sampling does not use priorities
+        pass
+
+
+class FeatureReplayBuffer:
+    """
+    Ring buffer of feature observations, for agents approximating Q over
+    SnakeEnvironment(features=True). States are stored as float32 rows
+    instead of IDs; batches are ReplayBatch arrays with (N, features)
+    states and next_states.
+    """
+    def __init__(self, capacity, features, seed=None):
+        self.capacity = capacity
+        self.rng = np.random.default_rng(seed)
+        self.states = np.zeros((capacity, features), dtype=np.float32)
+        self.actions = np.zeros(capacity, dtype=np.int8)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.next_states = np.zeros((capacity, features), dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.position = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, experience):
+        state, action, reward, next_state, done = experience
+        index = self.position
+        self.states[index] = state
+        self.actions[index] = ACTION_INDEX[action]
+        self.rewards[index] = reward
+        self.next_states[index] = next_state
+        self.dones[index] = done
+        self.position = (index + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, batch_size):
+        indices = self.rng.integers(0, self.size, size=batch_size)
+        return ReplayBatch(indices, self.states[indices],
+                           self.actions[indices], self.rewards[indices],
+                           self.next_states[indices], self.dones[indices],
+                           np.ones(batch_size, dtype=np.float32))
+
+    def update_priorities(self, indices, td_errors):
+        pass
+
+
+class SumTree:
+    """
+    Binary tree over `capacity` leaf priorities where every node holds the
+    sum of its children, so proportional sampling and priority updates are
+    O(log capacity). Leaves are padded to a power of two so a batch walks
+    down the tree together with array operations.
+    """
+    def __init__(self, capacity):
+        self.leaves = 1 << max(0, capacity - 1).bit_length()
+        self.depth = self.leaves.bit_length() - 1
+        self.nodes = np.zeros(2 * self.leaves - 1, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.nodes[0]
+
+    def update_one(self, leaf_index, priority):
+        node = leaf_index + self.leaves - 1
+        change = priority - self.nodes[node]
+        self.nodes[node] = priority
+        while node:
+            node = (node - 1) // 2
+            self.nodes[node] += change
+
+    def update(self, leaf_indices, priorities):
+        nodes = np.asarray(leaf_indices) + self.leaves - 1
+        self.nodes[nodes] = priorities
+        for _ in range(self.depth):
+            # duplicates are fine: parents are recomputed from their children
+            nodes = np.unique((nodes - 1) // 2)
+            self.nodes[nodes] = self.nodes[2 * nodes + 1] + \
+                self.nodes[2 * nodes + 2]
+
+    def find(self, values):
+        """
+        Returns the leaf index where each cumulative priority in `values`
+        falls.
+        """
+        values = np.array(values, dtype=np.float64)
+        nodes = np.zeros(len(values), dtype=np.int64)
+        for _ in range(self.depth):
+            left = 2 * nodes + 1
+            go_right = values > self.nodes[left]
+            values -= np.where(go_right, self.nodes[left], 0)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - (self.leaves - 1)
+
+    def priorities(self, leaf_indices):
+        return self.nodes[np.asarray(leaf_indices) + self.leaves - 1]
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """
+    ReplayBuffer sampling experiences in proportion to
+    (|td_error| + epsilon) ** alpha, backed by a SumTree. New experiences
+    get the highest priority seen so far so each is replayed at least once.
+    Sampled batches carry importance-sampling weights
+    (size * P(i)) ** -beta, normalized by their maximum.
+    """
+    def __init__(self, capacity, vocabulary=None, seed=None, alpha=0.6,
+                 beta=0.4, epsilon=1e-3):
+        super().__init__(capacity, vocabulary, seed)
+        self.alpha = alpha
+        self.beta = beta
+        self.epsilon = epsilon
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+
+    def store(self, index, state_id, action_index, reward, next_state_id,
+              done):
+        super().store(index, state_id, action_index, reward, next_state_id,
+                      done)
+        self.tree.update_one(index, self.max_priority)
+
+    def extend(self, state_ids, action_indexes, rewards, next_state_ids,
+               dones):
+        indices = super().extend(state_ids, action_indexes, rewards,
+                                 next_state_ids, dones)
+        self.tree.update(indices, self.max_priority)
+        return indices
+
+    def sample(self, batch_size):
+        # one stratified draw per equal slice of the total priority
+        total = self.tree.total
+        values = (np.arange(batch_size) +
+                  self.rng.random(batch_size)) * (total / batch_size)
+        indices = np.minimum(self.tree.find(values), self.size - 1)
+        probabilities = self.tree.priorities(indices) / total
+        weights = (self.size * probabilities) ** -self.beta
+        weights /= weights.max()
+        return self._batch(indices, weights.astype(np.float32))
+
+    def update_priorities(self, indices, td_errors):
+        priorities = (np.abs(np.asarray(td_errors, dtype=np.float64)) +
+                      self.epsilon) ** self.alpha
+        self.tree.update(indices, priorities)
+        self.max_priority = max(self.max_priority, float(priorities.max()))
@@ -0,0 +1,80 @@
+import numpy as np
+
+# -----------------------------------------------------------------------
+# Multi-step returns of a whole finished episode, computed backwards with
+# array operations.
+#
+# Every function takes the episode's rewards and `next_values`, the max
+# Q-value of every transition's next state (0 after the terminal step), in
+# step order. If the episode was cut short instead of ending in a terminal
+# state, `done` is False and the returns bootstrap from the value of the
+# last next state.
+# -----------------------------------------------------------------------
+
+# longest block of discounted_sums, and the smallest discount ** length a
+# block may scale by, far from the float64 underflow
+BLOCK = 256
+SMALLEST_SCALE = 1e-100
+
+
+def discounted_sums(values, discount):
+    """
+    Returns y with y[t] = values[t] + discount * y[t + 1], y past the end
+    being 0.
+
+    Within a block the recurrence is a reversed cumulative sum of
+    values[t] * discount ** t, divided back by discount ** t; blocks are
+    processed from the last one, carrying y of the block after. Blocks are
+    shortened for small discounts so discount ** length never underflows.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if not discount:
+        return values.copy()
+    block_size = BLOCK
+    if discount ** BLOCK < SMALLEST_SCALE:
+        block_size = max(1, int(np.log(SMALLEST_SCALE) / np.log(discount)))
+    sums = np.empty_like(values)
+    carry = 0.0
+    for end in range(len(values), 0, -block_size):
+        start = max(0, end - block_size)
+        powers = discount ** np.arange(end - start + 1, dtype=np.float64)
+        scaled = values[start:end] * powers[:-1]
+        block = np.cumsum(scaled[::-1])[::-1]
+        block += carry * powers[-1]
+        sums[start:end] = block / powers[:-1]
+        carry = sums[start]
+    return sums
+
+
+def n_step_returns(rewards, next_values, gamma, n, done=True):
+    """
+    Returns G[t] = r[t] + ... + gamma ** (k - 1) * r[t + k - 1]
+    + gamma ** k * V(s[t + k]), with k = n or the steps left in the episode.
+    """
+    rewards = np.asarray(rewards, dtype=np.float64)
+    next_values = np.asarray(next_values, dtype=np.float64)
+    steps = len(rewards)
+    to_go = discounted_sums(rewards, gamma)
+    # rewards past t + n are the discounted to-go of t + n, shifted
+    bootstrap_steps = np.minimum(np.arange(steps) + n, steps)
+    k = bootstrap_steps - np.arange(steps)
+    returns = to_go - gamma ** k * np.append(to_go, 0.0)[bootstrap_steps]
+    bootstrap_values = next_values[bootstrap_steps - 1]
+    if done:
+        # only the steps whose horizon ends before the terminal bootstrap
+        bootstrap_values = np.where(bootstrap_steps < steps,
+                                    bootstrap_values, 0.0)
+    return returns + gamma ** k * bootstrap_values
+
+
+def lambda_returns(rewards, next_values, gamma, trace_lambda, done=True):
+    """
+    Returns the λ-returns G[t] = r[t] + gamma * ((1 - λ) * V(s[t + 1])
+    + λ * G[t + 1]), bootstrapping from V(s[T]) at the end of a truncated
+    episode. λ = 0 is the one-step target, λ = 1 the Monte Carlo return.
+    """
+    targets = np.asarray(rewards, dtype=np.float64) + \
+        gamma * (1 - trace_lambda) * np.asarray(next_values, dtype=np.float64)
+    if not done:
+        targets[-1] += gamma * trace_lambda * next_values[-1]
+    return discounted_sums(targets, gamma * trace_lambda)
@@ -0,0 +1,72 @@
+import math
+from collections import Counter
+from statistics import NormalDist
+
+# -----------------------------------------------------------------------
+# Streaming statistics of benchmark games, updated one game at a time so an
+# evaluation can stop as soon as its confidence interval is narrow enough.
+#
+# The mean and variance use Welford's algorithm. Quantiles come from a
+# count of every distinct value: snake lengths, steps and rewards of a game
+# take few distinct values, so the sketch is exact and stays small, and its
+# quantiles interpolate like numpy.percentile.
+# -----------------------------------------------------------------------
+
+
+class RunningStats:
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared differences from the mean
+        self.m2 = 0.0
+        self.max = None
+        self.counts = Counter()
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.max = value if self.max is None else max(self.max, value)
+        self.counts[value] += 1
+
+    @property
+    def variance(self):
+        # sample variance, 0 until there are two values
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def confidence_interval(self, confidence=0.95):
+        """
+        Returns the (low, high) normal confidence interval of the mean,
+        infinite until there are two values.
+        """
+        if self.count < 2:
+            return -math.inf, math.inf
+        z = NormalDist().inv_cdf((1 + confidence) / 2)
+        margin = z * math.sqrt(self.variance / self.count)
+        return self.mean - margin, self.mean + margin
+
+    def quantile(self, q):
+        """
+        Returns the `q` quantile, 0 <= q <= 1, with the linear interpolation
+        of numpy.percentile, or NaN before the first value.
+        """
+        if not self.count:
+            return math.nan
+        position = q * (self.count - 1)
+        below = math.floor(position)
+        lower = upper = None
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if lower is None and seen > below:
+                lower = value
+            if seen > below + 1 or seen == self.count:
+                upper = value
+                break
+        return lower + (upper - lower) * (position - below)
+
+    def summary(self):
+        p5, median, p95 = (self.quantile(q) for q in (0.05, 0.5, 0.95))
+        mean = self.mean if self.count else math.nan
+        return {"mean": mean, "median": median, "p5": p5, "p95": p95}
@@ -0,0 +1,322 @@
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import time
+from multiprocessing import get_context
+
+import numpy as np
+
+from agents import QLearningAgent
+from constants import LastHappening
+from environments import SnakeEnvironment
+from game import SnakeGame
+from q_tables import DenseQTable, VOCABULARIES
+from train_agent import play_game, quiet_stdout, train_agent
+
+# -----------------------------------------------------------------------
+# Hyperparameter sweeps of QLearningAgent training over a process pool.
+#
+#   python sweeps.py --trials 32 --processes 8 -o sweep.json
+#   python sweeps.py --space space.json
+#
+# A search space maps every parameter of a trial config to a list of
+# values, or for random search to ["uniform", low, high] or
+# ["log_uniform", low, high]. Parameters are the agent's alpha, gamma,
+# epsilon_decay, batch_size and buffer_size, the environment's max_steps,
+# and "reward.<HAPPENING>" for every LastHappening reward.
+#
+# Trials evaluate the greedy policy every `eval_interval` episodes on the
+# same seeded games of `eval_max_steps` steps at most, whatever max_steps
+# they train with, and stop early when their average snake length is
+# below the median other trials had at the same point (median stopping
+# rule). Finished and stopped trials are cached in `cache_dir` as JSON
+# files named by the hash of their config and run settings, so a repeated
+# sweep only runs the trials it has not run yet.
+# -----------------------------------------------------------------------
+
+# around the hand-tuned values of train_agent's __main__
+SEARCH_SPACE = {
+    "alpha": [0.05, 0.1, 0.2],
+    "gamma": [0.8, 0.9, 0.95],
+    "epsilon_decay": [0.99, 0.995, 0.998],
+    "batch_size": [64, 256],
+    "buffer_size": [4000, 16000],
+    "max_steps": [200, 500],
+    "reward.GREEN_APPLE_EATEN": [100],
+    "reward.RED_APPLE_EATEN": [-100],
+    "reward.NO_COLLISION": [-1, -5],
+    "reward.DIED": [-1000],
+}
+
+DEFAULT_CONFIG = {"alpha": 0.1, "gamma": 0.9, "epsilon_decay": 0.995,
+                  "batch_size": 256, "buffer_size": 16000, "max_steps": 500}
+
+_checkpoints = None
+_lock = None
+
+
+def grid_configs(space):
+    """
+    Returns every combination of the values of `space`, all lists.
+    """
+    names = list(space)
+    return [dict(zip(names, values))
+            for values in itertools.product(*(space[name] for name in names))]
+
+
+def random_configs(space, trials, seed=0):
+    """
+    Returns `trials` configs drawing every parameter independently: a
+    uniform choice from a list, or a uniform or log-uniform float from
+    ["uniform", low, high] and ["log_uniform", low, high].
+    """
+    rng = random.Random(seed)
+    configs = []
+    for _ in range(trials):
+        config = {}
+        for name, values in space.items():
+            if values and values[0] == "uniform":
+                config[name] = rng.uniform(values[1], values[2])
+            elif values and values[0] == "log_uniform":
+                config[name] = float(np.exp(rng.uniform(np.log(values[1]),
+                                                        np.log(values[2]))))
+            else:
+                config[name] = rng.choice(values)
+        configs.append(config)
+    return configs
+
+
+def config_hash(config, settings):
+    """
+    Cache key of a trial: the hash of its config and of the run settings
+    its scores depend on.
+    """
+    key = json.dumps({"config": config, "settings": settings}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _rewards(config):
+    rewards = {}
+    for name, value in config.items():
+        if name.startswith("reward."):
+            happening = name[len("reward."):]
+            if happening not in LastHappening.__members__:
+                raise ValueError(f"Unknown reward {name!r}")
+            rewards[LastHappening[happening]] = value
+    return rewards
+
+
+def evaluate(agent, grid_size, max_steps, games, seed):
+    """
+    Average snake length of the greedy policy over `games` games, played on
+    a game seeded with `seed`, so every evaluation plays the same boards.
+    """
+    environment = SnakeEnvironment(SnakeGame(grid_size=grid_size, seed=seed),
+                                   max_steps)
+    lengths = [play_game(agent, environment, delay=0, verbose=False)[2]
+               for _ in range(games)]
+    return sum(lengths) / games
+
+
+def _init_worker(checkpoints, lock):
+    global _checkpoints, _lock
+    _checkpoints = checkpoints
+    _lock = lock
+
+
+def _should_stop(checkpoint, score, grace, min_trials):
+    """
+    Records `score` at `checkpoint` and applies the median stopping rule
+    against the scores other trials recorded there before.
+    """
+    with _lock:
+        scores = _checkpoints.get(checkpoint, [])
+        _checkpoints[checkpoint] = scores + [score]
+    if checkpoint < grace or len(scores) < min_trials:
+        return False
+    return score < float(np.median(scores))
+
+
+def run_trial(config, settings):
+    """
+    Trains a QLearningAgent with `config`, completed by DEFAULT_CONFIG in
+    `sweep`, and evaluates it every `eval_interval` episodes, stopping
+    early on the median stopping rule when run by `sweep`.
+    Returns:
+        dict: config, hash, scores at every evaluation, score (the last
+            one), episodes trained, stopped, and seconds.
+    """
+    seed = settings["seed"]
+    random.seed(seed)
+    environment = SnakeEnvironment(
+        SnakeGame(grid_size=settings["grid_size"], seed=seed),
+        config["max_steps"], rewards=_rewards(config))
+    agent = QLearningAgent(alpha=config["alpha"], gamma=config["gamma"],
+                           epsilon=0.9, epsilon_decay=config["epsilon_decay"],
+                           minimum_epsilon=0.02,
+                           buffer_size=int(config["buffer_size"]),
+                           batch_size=int(config["batch_size"]),
+                           q_table=DenseQTable(VOCABULARIES["depth"]))
+
+    start = time.perf_counter()
+    scores = []
+    stopped = False
+    episodes = 0
+    while episodes < settings["episodes"] and not stopped:
+        # keep the per-episode prints off the shared terminal
+        with quiet_stdout():
+            episodes += len(train_agent(
+                agent, environment,
+                min(settings["eval_interval"],
+                    settings["episodes"] - episodes)))
+        scores.append(evaluate(agent, settings["grid_size"],
+                               settings["eval_max_steps"],
+                               settings["eval_games"], settings["eval_seed"]))
+        if _lock is not None and episodes < settings["episodes"]:
+            stopped = _should_stop(len(scores) - 1, scores[-1],
+                                   settings["grace"], settings["min_trials"])
+    return {"config": config, "scores": scores, "score": scores[-1],
+            "episodes": episodes, "stopped": stopped,
+            "seconds": time.perf_counter() - start}
+
+
+def _run_cached(config, settings, cache_dir):
+    result = run_trial(config, settings)
+    result["hash"] = config_hash(config, settings)
+    if cache_dir is not None:
+        # write then rename, so an interrupted sweep never leaves half a file
+        path = os.path.join(cache_dir, result["hash"] + ".json")
+        with open(path + ".tmp", 'w') as f:
+            json.dump(result, f)
+        os.replace(path + ".tmp", path)
+    return result
+
+
+def sweep(configs, episodes=1000, eval_interval=100, eval_games=20,
+          grid_size=10, processes=None, cache_dir="sweep_cache", grace=2,
+          min_trials=4, seed=0, eval_max_steps=500):
+    """
+    Runs a trial of every config across a process pool, best scores first.
+
+    Args:
+        configs (list): Trial configs, from grid_configs or random_configs.
+        episodes (int): Training episodes of a trial that is not stopped.
+        eval_interval (int): Episodes between two evaluations.
+        eval_games (int): Games of every evaluation.
+        grid_size (int): Grid size of the games.
+        processes (int): Pool size, os.cpu_count() by default.
+        cache_dir (str): Directory of the cached results, None for no cache.
+        grace (int): Evaluations before a trial can be stopped.
+        min_trials (int): Scores other trials must have recorded at an
+            evaluation before it can stop a trial.
+        seed (int): Seed of the training games and exploration of every
+            trial; the evaluation games use seed + 1.
+        eval_max_steps (int): Max steps of the evaluation games, the same
+            for every trial so their scores compare.
+    Returns:
+        list: Results of run_trial with their hash and whether they came
+            from the cache: finished trials by score, then stopped trials
+            by the episodes they reached and their score.
+    """
+    settings = {"episodes": episodes, "eval_interval": eval_interval,
+                "eval_games": eval_games, "grid_size": grid_size,
+                "seed": seed, "eval_seed": seed + 1,
+                "eval_max_steps": eval_max_steps, "grace": grace,
+                "min_trials": min_trials}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    configs = [{**DEFAULT_CONFIG, **config} for config in configs]
+    results = []
+    pending = []
+    for config in configs:
+        path = None if cache_dir is None else os.path.join(
+            cache_dir, config_hash(config, settings) + ".json")
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                results.append(dict(json.load(f), cached=True))
+        else:
+            pending.append(config)
+    print(f"{len(configs)} trials, {len(results)} cached, "
+          f"{len(pending)} to run")
+
+    if pending:
+        context = get_context()
+        with context.Manager() as manager:
+            # cached trials count towards the medians of the new ones
+            checkpoints = manager.dict()
+            for result in results:
+                for checkpoint, score in enumerate(result["scores"]):
+                    checkpoints[checkpoint] = \
+                        checkpoints.get(checkpoint, []) + [score]
+            with context.Pool(processes, _init_worker,
+                              (checkpoints, manager.Lock())) as pool:
+                jobs = [pool.apply_async(_run_cached,
+                                         (config, settings, cache_dir))
+                        for config in pending]
+                for job in jobs:
+                    result = dict(job.get(), cached=False)
+                    results.append(result)
+                    print_result(result)
+
+    # a stopped trial's score is from an earlier evaluation: finished trials
+    # first, then the ones stopped later, each by score
+    results.sort(key=lambda result: (not result["stopped"], result["episodes"],
+                                     result["score"]), reverse=True)
+    return results
+
+
+def print_result(result):
+    status = "stopped" if result["stopped"] else "done"
+    config = " ".join(f"{name}={value:.4g}" if isinstance(value, float)
+                      else f"{name}={value}"
+                      for name, value in result["config"].items())
+    print(f"{result['score']:>8.2f} {status:<8}{result['episodes']:>7} ep "
+          f"{result['seconds']:>7.1f} s  {config}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Hyperparameter sweep of QLearningAgent training.")
+    parser.add_argument("--space", help="JSON file of the search space, "
+                                        "SEARCH_SPACE by default")
+    parser.add_argument("--trials", type=int,
+                        help="random search of this many trials instead of "
+                             "the whole grid")
+    parser.add_argument("--episodes", type=int, default=1000)
+    parser.add_argument("--eval-interval", type=int, default=100)
+    parser.add_argument("--eval-games", type=int, default=20)
+    parser.add_argument("--eval-max-steps", type=int, default=500,
+                        help="max steps of the evaluation games")
+    parser.add_argument("--grid-size", type=int, default=10)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--cache-dir", default="sweep_cache")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--grace", type=int, default=2)
+    parser.add_argument("--min-trials", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="JSON file of the results")
+    arguments = parser.parse_args()
+
+    space = SEARCH_SPACE
+    if arguments.space:
+        with open(arguments.space) as f:
+            space = json.load(f)
+    if arguments.trials:
+        configs = random_configs(space, arguments.trials, arguments.seed)
+    else:
+        configs = grid_configs(space)
+    results = sweep(configs, arguments.episodes, arguments.eval_interval,
+                    arguments.eval_games, arguments.grid_size,
+                    arguments.processes,
+                    None if arguments.no_cache else arguments.cache_dir,
+                    arguments.grace, arguments.min_trials, arguments.seed,
+                    arguments.eval_max_steps)
+    print("Best trials:")
+    for result in results[:5]:
+        print_result(result)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=2)
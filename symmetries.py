@@ -0,0 +1,79 @@
+from constants import Directions
+
+# -----------------------------------------------------------------------
+# The 8 symmetries of the square board (4 rotations, each with or without
+# a mirror) as permutations of the direction indexes, in Directions order
+# LEFT, UP, RIGHT, DOWN.
+#
+# Under permutation p, whatever the snake sees in direction i is seen in
+# direction p[i], and action i becomes action p[i]. Observations of the
+# vision encoders are canonicalized to the smallest of their 8 images, so
+# rotated and mirrored situations share one Q-table row.
+# -----------------------------------------------------------------------
+
+DIRECTIONS = list(Directions)
+DIRECTION_INDEX = {direction: index for index, direction
+                   in enumerate(DIRECTIONS)}
+MIRROR = (2, 1, 0, 3)  # swaps left and right
+
+SYMMETRIES = tuple(
+    tuple((mirrored[i] + quarter_turns) % 4 for i in range(4))
+    for mirrored in ((0, 1, 2, 3), MIRROR)
+    for quarter_turns in range(4)
+)
+INVERSES = tuple(
+    tuple(permutation.index(i) for i in range(4))
+    for permutation in SYMMETRIES
+)
+IDENTITY = 0
+
+_canonical = {"terminal": ("terminal", IDENTITY)}
+_canonical_ids = {}
+
+
+def transform(state, symmetry):
+    """
+    Returns the image of a four-direction observation under SYMMETRIES[
+    symmetry].
+    """
+    image = [None] * 4
+    for direction, token in zip(SYMMETRIES[symmetry], state):
+        image[direction] = token
+    return tuple(image)
+
+
+def canonicalize(state):
+    """
+    Returns the canonical representative of `state` and the index of the
+    symmetry mapping `state` onto it. Results are cached, the observation
+    spaces being small.
+    """
+    result = _canonical.get(state)
+    if result is None:
+        result = _canonical[state] = min(
+            (transform(state, symmetry), symmetry)
+            for symmetry in range(len(SYMMETRIES)))
+    return result
+
+
+def canonical_ids(vocabulary):
+    """
+    Returns, for every state ID of `vocabulary`, the ID of its canonical
+    representative and the index of the symmetry mapping it there, as two
+    lists. Computed once per vocabulary.
+    """
+    tables = _canonical_ids.get(vocabulary.name)
+    if tables is None:
+        canonical = [canonicalize(state) for state in vocabulary.states]
+        tables = _canonical_ids[vocabulary.name] = (
+            [vocabulary.ids[state] for state, _ in canonical],
+            [symmetry for _, symmetry in canonical])
+    return tables
+
+
+def to_canonical_action(action, symmetry):
+    return DIRECTIONS[SYMMETRIES[symmetry][DIRECTION_INDEX[action]]]
+
+
+def from_canonical_action(action, symmetry):
+    return DIRECTIONS[INVERSES[symmetry][DIRECTION_INDEX[action]]]
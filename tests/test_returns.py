@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from returns import discounted_sums, lambda_returns, n_step_returns
+
+
+def _lambda_returns_loop(rewards, next_values, gamma, trace_lambda, done):
+    returns = np.zeros(len(rewards))
+    following = 0.0 if done else next_values[-1]
+    for t in range(len(rewards) - 1, -1, -1):
+        returns[t] = rewards[t] + gamma * ((1 - trace_lambda) * next_values[t]
+                                           + trace_lambda * following)
+        following = returns[t]
+    return returns
+
+
+def _n_step_returns_loop(rewards, next_values, gamma, n, done):
+    steps = len(rewards)
+    returns = np.zeros(steps)
+    for t in range(steps):
+        k = min(n, steps - t)
+        returns[t] = sum(gamma ** i * rewards[t + i] for i in range(k))
+        if t + k < steps or not done:
+            returns[t] += gamma ** k * next_values[t + k - 1]
+    return returns
+
+
+@pytest.mark.parametrize("steps", [1, 5, 700])
+@pytest.mark.parametrize("done", [True, False])
+@pytest.mark.parametrize("gamma, trace_lambda",
+                         [(0.9, 0.8), (0.99, 1.0), (0.9, 0.0), (0.0, 0.5)])
+def test_lambda_returns(steps, done, gamma, trace_lambda):
+    rng = np.random.default_rng(steps)
+    rewards, next_values = rng.normal(size=(2, steps))
+    if done:
+        next_values[-1] = 0
+    assert np.allclose(
+        lambda_returns(rewards, next_values, gamma, trace_lambda, done),
+        _lambda_returns_loop(rewards, next_values, gamma, trace_lambda, done))
+
+
+@pytest.mark.parametrize("trace_lambda", [0.05, 0.01, 1e-6])
+def test_lambda_returns_small_lambda_long_episode(trace_lambda):
+    rng = np.random.default_rng(0)
+    rewards, next_values = rng.normal(size=(2, 300))
+    next_values[-1] = 0
+    returns = lambda_returns(rewards, next_values, 0.9, trace_lambda)
+    assert np.isfinite(returns).all()
+    assert np.allclose(returns, _lambda_returns_loop(
+        rewards, next_values, 0.9, trace_lambda, True))
+
+
+@pytest.mark.parametrize("steps", [1, 5, 700])
+@pytest.mark.parametrize("done", [True, False])
+@pytest.mark.parametrize("n", [1, 3, 1000])
+def test_n_step_returns(steps, done, n):
+    rng = np.random.default_rng(steps)
+    rewards, next_values = rng.normal(size=(2, steps))
+    if done:
+        next_values[-1] = 0
+    assert np.allclose(n_step_returns(rewards, next_values, 0.9, n, done),
+                       _n_step_returns_loop(rewards, next_values, 0.9, n,
+                                            done))
+
+
+def test_discounted_sums_zero_discount():
+    values = np.arange(4.0)
+    assert np.array_equal(discounted_sums(values, 0.0), values)
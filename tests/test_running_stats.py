@@ -0,0 +1,28 @@
+import math
+
+import numpy as np
+import pytest
+
+from running_stats import RunningStats
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 7, 100])
+def test_mean_variance_and_quantiles_match_numpy(count):
+    values = np.random.default_rng(count).integers(0, 20, count)
+    stats = RunningStats()
+    for value in values.tolist():
+        stats.add(value)
+    assert stats.mean == pytest.approx(values.mean())
+    if count > 1:
+        assert stats.variance == pytest.approx(values.var(ddof=1))
+    assert stats.max == values.max()
+    for q in (0, 0.05, 0.5, 0.95, 1):
+        assert stats.quantile(q) == pytest.approx(np.percentile(values, q * 100))
+
+
+def test_empty():
+    stats = RunningStats()
+    assert math.isnan(stats.quantile(0.5))
+    assert all(math.isnan(value) for value in stats.summary().values())
+    assert stats.variance == 0.0
+    assert stats.confidence_interval() == (-math.inf, math.inf)
@@ -0,0 +1,34 @@
+import numpy as np
+
+from agents import QLearningAgent
+from environments import SnakeEnvironment
+from game import SnakeGame
+from q_tables import DenseQTable, VOCABULARIES
+from train_agent import benchmark_agent, compare_agents
+
+
+def _agent():
+    # a fixed, arbitrary greedy policy
+    agent = QLearningAgent(q_table=DenseQTable(VOCABULARIES["depth"]))
+    agent.q_table.values[:] = np.random.default_rng(0).random(
+        agent.q_table.values.shape)
+    return agent
+
+
+def test_compare_agent_with_itself_on_a_seeded_game():
+    environment = SnakeEnvironment(SnakeGame(grid_size=10, seed=3), 200)
+    agent = _agent()
+    report = compare_agents(agent, agent, environment, games=20, seed=0,
+                            min_games=5)
+    assert report["games"] == 20
+    assert report["mean_difference"] == 0
+    interval = report["confidence_interval"]
+    assert (interval["low"], interval["high"]) == (0, 0)
+
+
+def test_benchmark_agent_repeats_on_a_seeded_game():
+    environment = SnakeEnvironment(SnakeGame(grid_size=10, seed=3), 200)
+    agent = _agent()
+    first = benchmark_agent(agent, environment, 10, seed=5)
+    second = benchmark_agent(agent, environment, 10, seed=5)
+    assert first == second
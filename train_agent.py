@@ -1,7 +1,15 @@
+import os
+import random
+from contextlib import contextmanager, redirect_stdout
+from multiprocessing import Pool
+
+import numpy as np
+
 from constants import LastHappening
 from game import SnakeGame
 from agents import QLearningAgent
-from environments import SnakeEnvironment
+from environments import DEPTH_VISION_TOKENS, SnakeEnvironment
+from running_stats import RunningStats
 from time import sleep
 
 
@@ -13,7 +21,11 @@ def train_agent(agent, environment, episodes):
         agent: An object with `act`, `store_experience`, and `train` methods.
         environment: An object with `reset`, `step(action)`, and optionally `render` methods.
         episodes (int): Number of episodes to train.
+    Returns:
+        list: The snake length at the end of every episode.
     """
+    adopt_observations(agent, environment)
+    lengths = []
     for episode in range(episodes):
         state, _, possible_actions, done, stats = environment.reset()
         total_reward = 0
@@ -31,16 +43,75 @@ def train_agent(agent, environment, episodes):
         agent.train()
         print(f"Episode {episode + 1}/{episodes}, Total Reward: {total_reward}")
         print(f"Snake Length: {stats} steps: {step}")
+        lengths.append(stats)
+    return lengths
+
+
+def adopt_observations(agent, environment):
+    """
+    Record the environment's encoder and symmetric setting in a
+    QLearningAgent about to train on it, so its model can be saved even from
+    packed integer states and is loaded in the right frame.
+
+    Raises:
+        ValueError: If the agent learned states of another encoder, or
+            in another frame, than the environment observes.
+    """
+    if getattr(environment, "encoder", None) is None:
+        return
+    encoder = getattr(agent, "encoder", None)
+    if encoder is None and isinstance(agent, QLearningAgent):
+        agent.encoder = encoder = environment.encoder.name
+    if encoder is not None and encoder != environment.encoder.name:
+        raise ValueError(f"The agent learned {encoder!r} states, the "
+                         f"environment observes {environment.encoder.name!r}")
+    symmetric = getattr(agent, "symmetric", None)
+    if symmetric is None and isinstance(agent, QLearningAgent):
+        agent.symmetric = symmetric = environment.symmetric
+    if symmetric is not None and symmetric != environment.symmetric:
+        raise ValueError("The agent learned symmetric states, the environment does not"
+                         if symmetric else
+                         "The environment observes symmetric states, the agent did not learn them")
+
+
+def train_agent_vectorized(agent, environment, episodes):
+    """
+    Train an agent on a VecSnakeEnvironment, stepping all of its boards at once.
 
+    Args:
+        agent: An object with `act`, `store_experience`, and `train` methods.
+        environment: A VecSnakeEnvironment.
+        episodes (int): Number of finished episodes to train for. The agent
+            trains once per finished episode, like `train_agent`.
+    """
+    states = environment.reset()
+    possible_actions = environment.possible_actions
+    finished = 0
 
-def play_game(agent, environment, delay=0.2, ignore_exploration=True):
+    while finished < episodes:
+        actions = [agent.act(state, possible_actions) for state in states]
+        next_states, rewards, dones, lengths = environment.step(actions)
+        for state, action, reward, next_state, done in zip(
+                states, actions, rewards.tolist(), next_states, dones.tolist()):
+            agent.store_experience(state, action, reward, next_state, done)
+        states = environment.states
+
+        for board in dones.nonzero()[0]:
+            agent.train()
+            finished += 1
+            print(f"Episode {finished}/{episodes}, Snake Length: {lengths[board]}")
+
+
+def play_game(agent, environment, delay=0.2, ignore_exploration=True, verbose=True):
     """
     Play a game using the trained agent.
 
     Args:
         agent: An object with `act` method.
         environment: An object with `reset`, `step(action)`, and optionally `render` methods.
+        verbose (bool): Print the result of the game.
     """
+    adopt_observations(agent, environment)
     state, _, possible_actions, done, stats = environment.reset()
     total_reward = 0
     steps = 0
@@ -52,46 +123,296 @@ def play_game(agent, environment, delay=0.2, ignore_exploration=True):
         total_reward += reward
         steps += 1
 
-        sleep(delay)  # Delay to better visualize the game
-        if total_reward == -1000 and stats == 3 and steps == 1:
+        if delay:
+            sleep(delay)  # Delay to better visualize the game
+        if verbose and total_reward == -1000 and stats == 3 and steps == 1:
             print(environment.game.snake.body, action.name)
 
-    print(f"Total Reward: {total_reward}")
-    print(f"Snake Length: {stats} steps: {steps}")
-    
+    if verbose:
+        print(f"Total Reward: {total_reward}")
+        print(f"Snake Length: {stats} steps: {steps}")
+
     return total_reward, steps, stats
 
 
-def benchmark_agent(agent, environment, games):
+def seed_game(environment, seed):
+    """
+    Seed `random` and, if the environment's game has its own random
+    generator (SnakeGame(seed=...)), that one too, so the next game is the
+    same whoever plays it.
+    """
+    random.seed(seed)
+    rng = getattr(getattr(environment, "game", None), "rng", random)
+    if rng is not random:
+        rng.seed(seed)
+
+
+def benchmark_agent(agent, environment, games, seed=None, ci_width=None, confidence=0.95, min_games=30):
     """
     Benchmark the agent by playing multiple games and calculating the average snake length and step count.
 
+    Statistics are updated after every game. With `ci_width`, the benchmark
+    stops as soon as the confidence interval of the average snake length is
+    narrower than it, `games` being the maximum.
+
     Args:
         agent: An object with `act` method.
         environment: An object with `reset`, `step(action)`, and optionally `render` methods.
-        games (int): Number of games to play for benchmarking.
+        games (int): Number of games to play for benchmarking, at most if `ci_width` is given.
+        seed (int): If given, game i is played with `seed_game(environment, seed + i)`,
+            the same games `benchmark_agent_parallel` plays.
+        ci_width (float): Width of the confidence interval to stop at.
+        confidence (float): Confidence level of the interval.
+        min_games (int): Games played before stopping early, so the
+            variance estimate is not from a handful of games.
+    Returns:
+        dict: The report of `summarize_games`, with the confidence_interval
+            of the average snake length.
     """
-    total_steps = 0
-    total_snake_length = 0
-    max_snake_length = 0
-    total_rewards = 0
-
+    stats = {name: RunningStats() for name in ("reward", "steps", "snake_length")}
     for game in range(games):
-        total_reward, step_count, snake_length = play_game(agent, environment, delay=0)
-        total_steps += step_count
-        total_snake_length += snake_length
-        total_rewards += total_reward
-        max_snake_length = max(max_snake_length, snake_length)
+        if seed is not None:
+            seed_game(environment, seed + game)
+        result = play_game(agent, environment, delay=0, verbose=False)
+        for running, value in zip(stats.values(), result):
+            running.add(value)
         # print(f"Game {game + 1}/{games}, Steps: {step_count}, Snake Length: {snake_length}")
+        if ci_width is not None and game + 1 >= min_games:
+            low, high = stats["snake_length"].confidence_interval(confidence)
+            if high - low <= ci_width:
+                break
+
+    report = summarize_running(stats, confidence)
+    print_benchmark_report(report)
+    return report
+
+
+def compare_agents(agent, other, environment, games, seed=0, ci_width=None, confidence=0.95, min_games=30):
+    """
+    Paired comparison of two agents: game i is played by both with
+    `seed_game(environment, seed + i)`, so they face the same boards, and the
+    difference of their snake lengths is averaged. Pairing cancels out the
+    luck of the boards, which usually needs far fewer games than comparing
+    two independent benchmarks.
+
+    Stops once the confidence interval of the average difference excludes
+    0 or, with `ci_width`, is narrower than it; `games` is the maximum.
+    Checking after every game makes the actual error rate somewhat higher
+    than 1 - `confidence`.
+
+    Args:
+        agent, other: Objects with `act` method.
+        environment: An object with `reset` and `step(action)` methods.
+        games (int): Maximum number of games each agent plays.
+        seed (int): Seed of the first game.
+        ci_width (float): Width of the confidence interval to stop at.
+        confidence (float): Confidence level of the interval.
+        min_games (int): Games played before stopping.
+    Returns:
+        dict: games, mean_difference (agent minus other) and its
+            confidence_interval, better ("agent", "other" or None if
+            undecided), and the snake_length summary of both agents.
+    """
+    differences = RunningStats()
+    lengths = (RunningStats(), RunningStats())
+    for game in range(games):
+        pair = []
+        for player, running in zip((agent, other), lengths):
+            seed_game(environment, seed + game)
+            pair.append(play_game(player, environment, delay=0, verbose=False)[2])
+            running.add(pair[-1])
+        differences.add(pair[0] - pair[1])
+        if game + 1 >= min_games:
+            low, high = differences.confidence_interval(confidence)
+            if low > 0 or high < 0 or (ci_width is not None and high - low <= ci_width):
+                break
+
+    low, high = differences.confidence_interval(confidence)
+    report = {
+        "games": differences.count,
+        "mean_difference": differences.mean,
+        "confidence_interval": {"confidence": confidence, "low": low, "high": high},
+        "better": "agent" if low > 0 else "other" if high < 0 else None,
+        "agent": lengths[0].summary(),
+        "other": lengths[1].summary(),
+    }
+    print(f"Games: {report['games']}")
+    print(f"Average Snake Length: {report['agent']['mean']} vs {report['other']['mean']}")
+    print(f"Difference: {report['mean_difference']}, {confidence:.0%} CI [{low}, {high}]")
+    print(f"Better: {report['better'] or 'undecided'}")
+    return report
+
+
+def benchmark_policy_vectorized(agent, environment, games):
+    """
+    Benchmark a PolicyAgent on every board of a VecSnakeEnvironment at once,
+    looking up the actions of all boards with one `act_batch` call per step.
+    Every board plays a fixed share of the games, so fast games finishing
+    first do not bias the report.
+
+    Args:
+        agent: A PolicyAgent over the depth vision vocabulary.
+        environment: A VecSnakeEnvironment, ideally with decode_states=False.
+        games (int): Number of finished games to summarize.
+    Returns:
+        dict: The report of `summarize_games`.
+    """
+    if agent.vocabulary.tokens != DEPTH_VISION_TOKENS:
+        raise ValueError("VecSnakeEnvironment observes depth vision only")
+    if agent.symmetric:
+        raise ValueError("The agent learned symmetric states, VecSnakeEnvironment does not observe them")
+    boards = environment.num_envs
+    environment.reset()
+    quotas = np.full(boards, games // boards)
+    quotas[:games % boards] += 1
+    total_rewards = np.zeros(boards)
+    steps = np.zeros(boards, dtype=np.int64)
+    results = []
+
+    while len(results) < games:
+        actions = agent.act_batch(agent.vocabulary.state_ids(environment.codes))
+        _, rewards, dones, lengths = environment.step(actions)
+        total_rewards += rewards
+        steps += 1
+        for board in (dones & (quotas > 0)).nonzero()[0]:
+            results.append((total_rewards[board], steps[board], lengths[board]))
+            quotas[board] -= 1
+        total_rewards[dones] = 0
+        steps[dones] = 0
+
+    report = summarize_games(results)
+    print_benchmark_report(report)
+    return report
+
+
+@contextmanager
+def quiet_stdout():
+    """
+    Sends stdout to os.devnull inside the block, to keep the progress
+    prints and traces of a worker process off the shared terminal.
+    Errors still reach stderr.
+    """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        yield
+
+
+# the agent and environment of a benchmark worker process, loaded once by
+# _init_benchmark_worker
+_worker_agent = None
+_worker_environment = None
+
+
+def _init_benchmark_worker(model_filename, agent_factory, grid_size, max_steps, encoder, symmetric):
+    global _worker_agent, _worker_environment
+    _worker_agent = agent_factory()
+    _worker_agent.load(model_filename)
+    _worker_environment = SnakeEnvironment(
+        SnakeGame(grid_size=grid_size, render=False), max_steps,
+        symmetric=symmetric, encoder=encoder)
+
+
+def _play_seeded_game(seed):
+    seed_game(_worker_environment, seed)
+    return play_game(_worker_agent, _worker_environment, delay=0, verbose=False)
+
+
+def benchmark_agent_parallel(model_filename, games, processes=None, seed=0,
+                             grid_size=10, max_steps=None,
+                             agent_factory=QLearningAgent, encoder=None, symmetric=None):
+    """
+    Benchmark a saved model over a process pool.
+
+    Every worker loads the model once. Game i is played after
+    `seed_game(environment, seed + i)`, so the report does not depend on
+    the number of workers and matches `benchmark_agent(..., seed=seed)`.
+
+    Args:
+        model_filename (str): Model file to load with `agent_factory().load`.
+        games (int): Number of games to play.
+        processes (int): Number of worker processes, all cores by default.
+        seed (int): Seed of the first game.
+        grid_size (int): Grid size of the SnakeGame.
+        max_steps (int): Max steps per episode of the SnakeEnvironment.
+        agent_factory: Picklable callable returning an agent with `load` and `act`.
+        encoder (str): Observation encoder of the games, the one the model
+            records by default. Required for older pickles that record none.
+        symmetric (bool): Observe canonical states, as the model records
+            by default.
+    Returns:
+        dict: The report of `summarize_games`.
+    Raises:
+        ValueError: If the model records no encoder and none is given.
+    """
+    # checked here, a worker failing in its initializer would be respawned
+    model = agent_factory()
+    model.load(model_filename)
+    if encoder is None:
+        encoder = getattr(model, "encoder", None)
+        if encoder is None:
+            raise ValueError(f"{model_filename} does not record its encoder, pass encoder=")
+    if symmetric is None:
+        symmetric = bool(getattr(model, "symmetric", False))
+    processes = processes or os.cpu_count()
+    chunksize = max(1, games // (processes * 4))
+    with Pool(processes, initializer=_init_benchmark_worker,
+              initargs=(model_filename, agent_factory, grid_size,
+                        max_steps, encoder, symmetric)) as pool:
+        results = pool.map(_play_seeded_game, range(seed, seed + games),
+                           chunksize)
+
+    report = summarize_games(results)
+    print_benchmark_report(report)
+    return report
+
+
+def summarize_games(results):
+    """
+    Summarize (total_reward, steps, snake_length) results of `play_game`.
+
+    Returns:
+        dict: games, max_snake_length, and the mean, median, p5 and p95 of
+            snake_length, steps and reward.
+    """
+    rewards, steps, lengths = (np.array(column, dtype=float)
+                               for column in zip(*results))
+    report = {"games": len(results), "max_snake_length": int(lengths.max())}
+    for name, values in (("snake_length", lengths), ("steps", steps),
+                         ("reward", rewards)):
+        p5, median, p95 = np.percentile(values, [5, 50, 95])
+        report[name] = {"mean": float(values.mean()), "median": float(median),
+                        "p5": float(p5), "p95": float(p95)}
+    return report
+
+
+def summarize_running(stats, confidence=0.95):
+    """
+    Summarize the RunningStats of `benchmark_agent` like `summarize_games`.
+
+    Returns:
+        dict: The keys of `summarize_games`, and the confidence_interval of
+            the average snake length.
+    """
+    lengths = stats["snake_length"]
+    report = {"games": lengths.count, "max_snake_length": int(lengths.max)}
+    for name in ("snake_length", "steps", "reward"):
+        report[name] = {key: float(value) for key, value in stats[name].summary().items()}
+    low, high = lengths.confidence_interval(confidence)
+    report["confidence_interval"] = {"confidence": confidence, "low": low, "high": high}
+    return report
 
-    average_steps = total_steps / games
-    average_snake_length = total_snake_length / games
-    average_total_reward = total_rewards / games
 
-    print(f"Average Steps: {average_steps}")
-    print(f"Average Snake Length: {average_snake_length}")
-    print(f"Max Snake Length: {max_snake_length}")
-    print(f"Average Total Reward: {average_total_reward}")
+def print_benchmark_report(report):
+    print(f"Average Steps: {report['steps']['mean']}")
+    print(f"Average Snake Length: {report['snake_length']['mean']}")
+    print(f"Max Snake Length: {report['max_snake_length']}")
+    print(f"Average Total Reward: {report['reward']['mean']}")
+    for name in ("snake_length", "steps", "reward"):
+        stats = report[name]
+        print(f"{name}: median {stats['median']}, p5 {stats['p5']}, p95 {stats['p95']}")
+    if "confidence_interval" in report:
+        interval = report["confidence_interval"]
+        print(f"Games: {report['games']}, {interval['confidence']:.0%} CI of the average snake length: "
+              f"[{interval['low']}, {interval['high']}]")
 
 
 if __name__ == "__main__":
@@ -117,7 +438,8 @@ if __name__ == "__main__":
 
     print(agent.q_table.__len__())
     environment.max_steps = 1000  # See how the agent performs with a higher max step count
-    benchmark_agent(agent, environment, 100)
+    # until the 95% CI of the average snake length is 0.5 wide, or 1000 games
+    benchmark_agent(agent, environment, 1000, seed=0, ci_width=0.5)
     # play a game with the model
     game.init_rendering()
     play_game(agent, environment)
@@ -0,0 +1,208 @@
+import glob
+import os
+import struct
+
+import numpy as np
+
+from constants import LastHappening
+from q_tables import ACTION_INDEX, VOCABULARIES, DenseQTable
+from replay_buffers import ReplayBatch
+
+# -----------------------------------------------------------------------
+# Append-only trajectory files recorded from SnakeEnvironment.step, and
+# offline Q-learning over them without any simulation.
+#
+# A recording is a directory of chunk files, each a 64 byte header (magic,
+# version, vocabulary name) followed by packed TRANSITION records. Chunks
+# are memory-mapped for reading; a record cut short by a crash is ignored.
+# -----------------------------------------------------------------------
+
+MAGIC = b"L2ST"
+VERSION = 1
+CHUNK_EXTENSION = ".l2st"
+HEADER = struct.Struct("<4sH26s32s")
+
+TRANSITION = np.dtype([
+    ("state", "<i4"),
+    ("action", "u1"),
+    ("reward", "<f4"),
+    ("next_state", "<i4"),
+    ("done", "?"),
+    # LastHappening value of the step, and whether the episode timed out,
+    # so the rewards can be recomputed for other reward settings
+    ("happening", "u1"),
+    ("timed_out", "?"),
+])
+
+
+class TrajectoryRecorder:
+    """
+    Streams (state_id, action, reward, next_state_id, done) records to
+    chunk files in `directory`. Records are buffered in memory and appended
+    to the current chunk `flush_every` at a time; a new chunk starts every
+    `chunk_size` records. Attach one with SnakeEnvironment(recorder=...).
+    """
+    def __init__(self, directory, vocabulary, chunk_size=1 << 22,
+                 flush_every=1 << 14):
+        self.directory = directory
+        self.vocabulary = vocabulary
+        self.chunk_size = chunk_size
+        os.makedirs(directory, exist_ok=True)
+        self.chunk_index = len(chunk_files(directory))
+        self.file = None
+        self.chunk_records = 0
+        self.pending = np.zeros(flush_every, dtype=TRANSITION)
+        self.pending_count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, state, action, reward, next_state, done, happening,
+               timed_out=False):
+        ids = self.vocabulary.ids
+        self.pending[self.pending_count] = (
+            ids[state], ACTION_INDEX[action], reward, ids[next_state], done,
+            happening.value, timed_out)
+        self.pending_count += 1
+        if self.pending_count == len(self.pending):
+            self.flush()
+
+    def flush(self):
+        records = self.pending[:self.pending_count]
+        while len(records):
+            if self.file is None or self.chunk_records == self.chunk_size:
+                self._open_chunk()
+            count = min(len(records), self.chunk_size - self.chunk_records)
+            records[:count].tofile(self.file)
+            self.chunk_records += count
+            records = records[count:]
+        self.pending_count = 0
+        if self.file is not None:
+            self.file.flush()
+
+    def _open_chunk(self):
+        if self.file is not None:
+            self.file.close()
+        filename = os.path.join(
+            self.directory, f"chunk_{self.chunk_index:06d}{CHUNK_EXTENSION}")
+        self.file = open(filename, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, b"",
+                                    self.vocabulary.name.encode()))
+        self.chunk_index += 1
+        self.chunk_records = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def chunk_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "*" + CHUNK_EXTENSION)))
+
+
+class TrajectoryDataset:
+    """
+    Read-only memory maps of every chunk of a recording directory.
+    """
+    def __init__(self, directory):
+        self.chunks = []
+        self.vocabulary = None
+        for filename in chunk_files(directory):
+            with open(filename, 'rb') as f:
+                magic, version, _, name = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"{filename} is not a version {VERSION} "
+                                 f"trajectory chunk")
+            vocabulary = VOCABULARIES[name.rstrip(b"\0").decode()]
+            if self.vocabulary not in (None, vocabulary):
+                raise ValueError(f"{filename} was recorded with another "
+                                 f"vocabulary")
+            self.vocabulary = vocabulary
+            count = (os.path.getsize(filename) - HEADER.size) // \
+                TRANSITION.itemsize
+            if count:
+                self.chunks.append(np.memmap(filename, dtype=TRANSITION,
+                                             mode='r', offset=HEADER.size,
+                                             shape=(count,)))
+
+    def __len__(self):
+        return sum(len(chunk) for chunk in self.chunks)
+
+    def batches(self, batch_size, rng=None):
+        """
+        Yields the whole dataset once as TRANSITION arrays of up to
+        `batch_size` records, chunks and records in random order if a
+        numpy Generator `rng` is given.
+        """
+        order = range(len(self.chunks)) if rng is None \
+            else rng.permutation(len(self.chunks))
+        for chunk_index in order:
+            chunk = self.chunks[chunk_index]
+            indices = np.arange(len(chunk)) if rng is None \
+                else rng.permutation(len(chunk))
+            for start in range(0, len(chunk), batch_size):
+                yield chunk[np.sort(indices[start:start + batch_size])]
+
+
+def rewards_of(records, rewards=None, timeout_reward=None):
+    """
+    Returns the rewards of `records`, recomputed from their happenings when
+    a `rewards` {LastHappening: reward} table is given. Timed out steps get
+    `timeout_reward`, the DIED reward by default, like SnakeEnvironment.
+    """
+    if rewards is None:
+        return records["reward"]
+    table = np.zeros(max(happening.value for happening in LastHappening) + 1,
+                     dtype=np.float32)
+    for happening in LastHappening:
+        table[happening.value] = rewards.get(happening, happening.reward())
+    if timeout_reward is None:
+        timeout_reward = table[LastHappening.DIED.value]
+    return np.where(records["timed_out"], timeout_reward,
+                    table[records["happening"]]).astype(np.float32)
+
+
+def train_offline(agent, dataset, epochs, batch_size=1 << 16, rewards=None,
+                  timeout_reward=None, seed=None):
+    """
+    Q-learning over recorded transitions with no simulation: every epoch
+    applies QLearningAgent.update_batch to the whole dataset in shuffled
+    batches.
+
+    Args:
+        agent: QLearningAgent with a DenseQTable over the dataset's
+            vocabulary.
+        dataset (TrajectoryDataset): The recorded transitions.
+        epochs (int): Number of passes over the dataset.
+        batch_size (int): Records per vectorized update.
+        rewards (dict): {LastHappening: reward} to train other reward
+            settings than the recorded ones.
+        timeout_reward (float): Reward of timed out steps with `rewards`.
+        seed (int): Seed of the shuffling.
+    Returns:
+        list: Mean absolute TD error of every epoch.
+    """
+    if not isinstance(agent.q_table, DenseQTable) or \
+            agent.q_table.vocabulary is not dataset.vocabulary:
+        raise ValueError("Offline training needs a DenseQTable over the "
+                         "vocabulary of the dataset")
+    rng = np.random.default_rng(seed)
+    errors = []
+    for epoch in range(epochs):
+        total_error = 0.0
+        for records in dataset.batches(batch_size, rng):
+            batch = ReplayBatch(
+                None, records["state"].astype(np.int64),
+                records["action"].astype(np.int64),
+                rewards_of(records, rewards, timeout_reward),
+                records["next_state"].astype(np.int64), records["done"],
+                np.ones(len(records), dtype=np.float32))
+            total_error += float(np.abs(agent.update_batch(batch)).sum())
+        errors.append(total_error / max(1, len(dataset)))
+        print(f"Epoch {epoch + 1}/{epochs}, Mean |TD error|: {errors[-1]:.3f}")
+    return errors
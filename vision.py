@@ -0,0 +1,86 @@
+from bisect import bisect_left, bisect_right, insort
+
+# object kinds, in the order of SnakeEnvironment's rich_vision entries
+GREEN = 0
+RED = 1
+WALL = 2
+SNAKE = 3
+
+
+class VisionIndex:
+    """
+    Sorted per-row and per-column coordinates of the snake segments, green
+    apples and red apple on a grid.
+
+    Answers "nearest green/red/wall/snake in direction d" with a bisect
+    instead of walking the ray cell by cell, so a look costs
+    O(log grid_size) whatever the size of the grid or the snake.
+    """
+    def __init__(self, grid_size):
+        self.grid_size = grid_size
+        self.clear()
+
+    def clear(self):
+        # rows[kind][y] holds the sorted x of every object of that kind on
+        # row y, columns[kind][x] the sorted y on column x
+        self.rows = {kind: [[] for _ in range(self.grid_size)]
+                     for kind in (GREEN, RED, SNAKE)}
+        self.columns = {kind: [[] for _ in range(self.grid_size)]
+                        for kind in (GREEN, RED, SNAKE)}
+
+    def rebuild(self, snake, green_apples, red_apple):
+        self.clear()
+        for segment in snake:
+            self.add(SNAKE, segment)
+        for apple in green_apples:
+            self.add(GREEN, apple.position)
+        self.add(RED, red_apple.position)
+
+    def add(self, kind, position):
+        x, y = position
+        # a head that went through the wall is never looked from
+        if 0 <= x < self.grid_size and 0 <= y < self.grid_size:
+            insort(self.rows[kind][y], x)
+            insort(self.columns[kind][x], y)
+
+    def remove(self, kind, position):
+        x, y = position
+        if 0 <= x < self.grid_size and 0 <= y < self.grid_size:
+            row = self.rows[kind][y]
+            del row[bisect_left(row, x)]
+            column = self.columns[kind][x]
+            del column[bisect_left(column, y)]
+
+    def move(self, kind, old_position, new_position):
+        self.remove(kind, old_position)
+        self.add(kind, new_position)
+
+    def look(self, head):
+        """
+        Returns the rich_vision of SnakeEnvironment.interpret from `head`:
+        for left, up, right and down, the distances to the nearest green,
+        red, wall and snake, with None for kinds not on the ray.
+        """
+        x, y = head
+        vision = [[None, None, x + 1, None],
+                  [None, None, y + 1, None],
+                  [None, None, self.grid_size - x, None],
+                  [None, None, self.grid_size - y, None]]
+        for kind in (GREEN, RED, SNAKE):
+            row = self.rows[kind][y]
+            if row:
+                i = bisect_left(row, x)
+                if i:
+                    vision[0][kind] = x - row[i - 1]
+                i = bisect_right(row, x)
+                if i < len(row):
+                    vision[2][kind] = row[i] - x
+            column = self.columns[kind][x]
+            if column:
+                i = bisect_left(column, y)
+                if i:
+                    vision[1][kind] = y - column[i - 1]
+                i = bisect_right(column, y)
+                if i < len(column):
+                    vision[3][kind] = column[i] - y
+        return vision
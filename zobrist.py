@@ -0,0 +1,85 @@
+import random
+
+from constants import Directions
+
+# -----------------------------------------------------------------------
+# Zobrist hashing of a SnakeGame board: the XOR of one random 64-bit key
+# per feature of the board, so moving a piece updates the hash with two
+# XORs.
+#
+# Features are the snake direction, the head cell, every body cell with the
+# direction of the next segment towards the tail (TAIL for the last one),
+# and the apple cells. The links make the hash depend on the order of the
+# body, not just the cells it covers.
+# -----------------------------------------------------------------------
+
+DIRECTIONS = list(Directions)
+DIRECTION_INDEX = {direction: index for index, direction
+                   in enumerate(DIRECTIONS)}
+LINK_INDEX = {direction.value: index for index, direction
+              in enumerate(DIRECTIONS)}
+TAIL = len(DIRECTIONS)
+
+
+class ZobristKeys:
+    """
+    The keys of every feature of a `grid_size` board, drawn from their own
+    seeded generator so hashing never consumes the game's randomness.
+    """
+    def __init__(self, grid_size, seed=0):
+        self.grid_size = grid_size
+        rng = random.Random(seed)
+        cells = grid_size * grid_size
+
+        def keys(count):
+            return [rng.getrandbits(64) for _ in range(count)]
+        self.direction = keys(len(DIRECTIONS))
+        self.head = keys(cells)
+        # body[link][cell]
+        self.body = [keys(cells) for _ in range(TAIL + 1)]
+        self.green = keys(cells)
+        self.red = keys(cells)
+
+    def cell(self, position):
+        # None for positions off the grid, such as a head that hit a wall
+        x, y = position
+        if 0 <= x < self.grid_size and 0 <= y < self.grid_size:
+            return x * self.grid_size + y
+        return None
+
+    def segment(self, position, next_position=None):
+        """
+        Key of a body segment at `position` whose next segment towards the
+        tail is at `next_position`, None for the tail.
+        """
+        cell = self.cell(position)
+        if cell is None:
+            return 0
+        if next_position is None:
+            return self.body[TAIL][cell]
+        link = (next_position[0] - position[0], next_position[1] - position[1])
+        return self.body[LINK_INDEX[link]][cell]
+
+    def head_key(self, position):
+        cell = self.cell(position)
+        return 0 if cell is None else self.head[cell]
+
+    def apple_key(self, apple):
+        cell = self.cell(apple.position)
+        keys = self.green if apple.type == 'green' else self.red
+        return 0 if cell is None else keys[cell]
+
+    def board_hash(self, snake, green_apples, red_apple):
+        """
+        Hashes a whole board from scratch.
+        """
+        body = snake.body
+        value = self.direction[DIRECTION_INDEX[snake.direction]]
+        if body:
+            value ^= self.head_key(body[0])
+        for i, segment in enumerate(body):
+            value ^= self.segment(segment,
+                                  body[i + 1] if i + 1 < len(body) else None)
+        for apple in green_apples + [red_apple]:
+            value ^= self.apple_key(apple)
+        return value